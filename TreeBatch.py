@@ -0,0 +1,264 @@
+# GenoMap Tree Explorer - command line renderer
+# Renders labelled trees to image files without tkinter so trees can be produced on headless machines.
+
+# Module Imports
+# System Functions
+import os
+import sys
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Qt needs no display when only writing image files
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+#Shared tree and table processing
+from TreeCore import (PALETTES, TableCache, cached_heatmap, cache_heatmap, read_table, Genomap, query_columns,
+                      subset_labels, label_mapping, load_newick, relabel_leaves, generate_colors,
+                      missing_cells, scale_heatmap, compile_query, colour_query, collapse_branches, colour_strains,
+                      heatmap_leaves, DETAIL_PIXELS, detail_clades, TreeDrawing, render_drawing, render_tiles)
+
+# Command line options
+def build_parser():
+    """Argument parser for the batch renderer"""
+    parser = argparse.ArgumentParser(
+        prog="trex-batch",
+        description="Render labelled phylogenetic trees to image files without the GUI. "
+                    "Lists of strains may be read from a file with @filename (one entry per line).",
+        fromfile_prefix_chars="@")
+    parser.add_argument("trees", nargs="+", metavar="tree",
+                        help="tree files in Newick format, glob patterns such as 'lineages/*.nwk' are expanded")
+    parser.add_argument("-o", "--output", default="tree_out.png",
+                        help="output image for a single tree, format taken from the extension (default: tree_out.png)")
+    parser.add_argument("--outdir", default=".",
+                        help="directory for images when several trees are rendered, trees with the same file name in different folders "
+                             "keep those folders (default: current directory)")
+    parser.add_argument("--format", default="png", choices=["png", "svg", "pdf"],
+                        help="image format when several trees are rendered (default: png)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes for several trees (default: number of CPUs)")
+    parser.add_argument("-g", "--genomap", help="genomap table (csv or Excel) with identifiers in the first column")
+    parser.add_argument("-l", "--labels", nargs="+", default=[], metavar="COLUMN",
+                        help="genomap columns used to label the tree")
+    parser.add_argument("-q", "--query", action="append", default=[],
+                        help='label search, e.g. "prtS=1 AND (pH<5 OR NOT Lysotype=A) -> yellow"; '
+                             'may be repeated, the first matching search colours a leaf')
+    parser.add_argument("-s", "--strains", nargs="+", default=[], metavar="ID", help="strains to colour")
+    parser.add_argument("--prune", nargs="+", default=[], metavar="ID", help="keep only these strains")
+    parser.add_argument("--collapse", nargs="+", default=[], metavar="ID",
+                        help="collapse branches containing these strains")
+    parser.add_argument("--collapse-depth", type=int, default=2, metavar="DEPTH",
+                        help="node depth at which branches are collapsed (default: 2)")
+    parser.add_argument("-m", "--heatmap", help="heatmap table (csv or Excel) with identifiers in the first column")
+    parser.add_argument("--palette", choices=list(PALETTES), default="Red-Orange-Yellow",
+                        help="heatmap colour scheme (default: Red-Orange-Yellow)")
+    parser.add_argument("--heatmap-values", action="store_true", help="show heatmap values instead of blocks")
+    parser.add_argument("--no-heatmap-labels", action="store_true", help="omit heatmap column names")
+    parser.add_argument("--topology", choices=["r", "c"], default="r", help="rectangular or circular tree")
+    parser.add_argument("--equalize-branch", action="store_true", help="draw all branches with equal length")
+    parser.add_argument("--detail-pixels", type=int, default=DETAIL_PIXELS, metavar="PIXELS",
+                        help="summarise clades drawn smaller than this as triangles with leaf count and most common "
+                             f"label (default: {DETAIL_PIXELS})")
+    parser.add_argument("--full-detail", action="store_true", help="draw every leaf of large trees")
+    parser.add_argument("--tiles", metavar="DIR",
+                        help="write a single tree as zoomable image tiles with a viewer page (DIR/index.html), drawing "
+                             "every leaf across --jobs worker processes")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not read or write cached tables and parsed trees (set TREX_CACHE_DIR to move the "
+                             "cache, default ~/.cache/trex)")
+    parser.add_argument("--width", type=int, default=1200, help="image width in pixels (default: 1200)")
+    parser.add_argument("--height", type=int, default=800, help="image height in pixels (default: 800)")
+    return parser
+
+# Genomap labels and searches as in UploadGenogroup, subset and process_value
+def load_genomap(filename, labels, query=None, cache=None):
+    """Read the genomap columns used for labels and searches, returning ((table, label subset), compiled search)"""
+    genomap = Genomap(filename, cache=cache)
+    unknown = [col for col in labels if col not in genomap.columns]
+    if unknown:
+        raise ValueError(f"Label columns not found in genomap: {', '.join(unknown)}")
+    # Queries are compiled once against the genomap columns
+    rules = compile_query(query, genomap.columns[1:]) if query else None
+    df = genomap.require(labels + (query_columns(rules) if rules else []))
+    return (df, subset_labels(df, labels)), rules
+
+# Heatmap processing as in minmaxdf
+def load_heatmap(filename, palette, cache=None):
+    """Read and scale a heatmap, returning (rows, columns, values, colours)"""
+    entry = cache.entry(filename, "heatmap") if cache is not None else None
+    cached = cached_heatmap(entry) if entry is not None else None
+    if cached is not None:
+        rows, columns, values = cached
+        return rows, columns, values, generate_colors(values, PALETTES[palette])
+    df = read_table(filename)
+    df = df.set_index(df.columns[0]) # First column is index
+    cells = missing_cells(df)
+    if cells:
+        shown = ", ".join(f"row {row} column {col}" for row, col in cells[:20])
+        raise ValueError(f"Missing values in {len(cells)} heatmap cells: {shown}")
+    values = scale_heatmap(df)
+    if entry is not None:
+        cache_heatmap(entry, df.index, df.columns, values)
+    return df.index.tolist(), df.columns.values.tolist(), values, generate_colors(values, PALETTES[palette])
+
+# Apply ShowTree styling and write the image
+def render_labelled(tree, output, options, genomap=None, heatmap=None, query=None):
+    """Label, style and render one parsed tree, returning messages about skipped data"""
+    messages = []
+    df, newdf = genomap if genomap is not None else (None, None)
+    reference = label_mapping(newdf) if newdf is not None else {}
+    relabel_leaves(tree, reference)
+
+    # Pruning if requested
+    if options.prune:
+        tree = tree.prune([reference.get(item, item) for item in options.prune])
+
+    # Collapse nodes containing selected strains
+    if options.collapse:
+        collapse_branches(tree, options.collapse_depth, [reference.get(item, item) for item in options.collapse])
+
+    # Colour tree leaves if requested
+    if query is not None:
+        colour_query(tree, reference, df, query)
+
+    # Apply strain colouring if selected
+    if options.strains:
+        found = colour_strains(tree, options.strains, reference)
+        if found < len(options.strains):
+            messages.append(f"{len(options.strains) - found} selected strains are not in the tree")
+
+    # ete3 nodes are built once the tree is ready to draw, skipping clades too small to see
+    summaries = [] if options.full_detail or options.tiles or options.detail_pixels <= 0 else \
+        detail_clades(tree, options.height // options.detail_pixels)
+
+    # Building the heatmap
+    cells, header = None, []
+    if heatmap is not None:
+        rows, columns, values, colours = heatmap
+        pairs, missing = heatmap_leaves(tree.leaf_index, reference, rows)
+        cells = (pairs, values, colours, options.heatmap_values)
+        if missing:
+            messages.append(f"{missing} heatmap rows do not match a tree leaf and were skipped")
+        if not options.no_heatmap_labels:
+            header = columns
+    if len(summaries):
+        messages.append(f"{len(summaries)} clades too small to draw were summarised")
+    drawing = TreeDrawing(tree, summaries, cells, options.topology, header)
+
+    if options.tiles: # tile workers build the ete3 nodes from the compact tree
+        levels = render_tiles(drawing, options.tiles, options.jobs, options.equalize_branch,
+                              progress=lambda message: print(f"    {message}", flush=True))
+        messages.append(f"{levels + 1} zoom levels written, open {os.path.join(options.tiles, 'index.html')}")
+    else:
+        size, seconds = render_drawing(drawing, output, w=options.width, h=options.height,
+                                       equalize_branch=options.equalize_branch)
+        messages.append(f"{size / 1e6:.2f} MB written in {seconds:.1f} s")
+    return messages
+
+# Expand tree arguments
+def tree_files(patterns):
+    """Paths from the command line with glob patterns expanded, keeping order and dropping repeats"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+# Output image for each tree of a batch
+def output_paths(paths, outdir, fmt):
+    """Image paths named after the tree files, keeping their folders below the common parent when names are shared,
+    raising ValueError if two trees would still write the same image"""
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    if len({os.path.normcase(name) for name in names}) < len(names): # lineages/a/x.nwk and lineages/b/x.nwk
+        common = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+        names = [os.path.splitext(os.path.relpath(os.path.abspath(path), common))[0] for path in paths]
+    outputs = [os.path.join(outdir, f"{name}.{fmt}") for name in names]
+    seen = {}
+    for path, output in zip(paths, outputs):
+        other = seen.setdefault(os.path.normcase(output), path)
+        if other != path:
+            raise ValueError(f"{other} and {path} would both be written to {output}")
+    return outputs
+
+# Shared inputs for rendering, set once per process
+_shared: dict = {}
+
+def _init_worker(options, genomap, heatmap, query):
+    """Receive the genomap, heatmap and compiled query once per worker instead of once per tree"""
+    _shared.update(options=options, genomap=genomap, heatmap=heatmap, query=query)
+
+def _render_file(path, output):
+    """Render one tree file with the shared inputs"""
+    options = _shared["options"]
+    tree = load_newick(path, None if options.no_cache else TableCache()) # parsed trees are reused between runs
+    return render_labelled(tree, output, options,_shared["genomap"], _shared["heatmap"], _shared["query"])
+
+# Render a list of trees across worker processes
+def render_batch(jobs, options, genomap=None, heatmap=None, query=None, workers=1):
+    """Render (tree, output) pairs, reporting progress and returning the trees that failed"""
+    failed = []
+    def report(done, path, output, messages, error):
+        if error is not None: # one bad tree should not stop the batch
+            failed.append(path)
+            print(f"[{done}/{len(jobs)}] {path}: FAILED - {error}", file=sys.stderr)
+        else:
+            print(f"[{done}/{len(jobs)}] {path} -> {output}")
+            for message in messages:
+                print(f"    {message}", file=sys.stderr)
+        sys.stdout.flush()
+
+    if workers <= 1 or len(jobs) == 1:
+        _init_worker(options, genomap, heatmap, query)
+        for done, (path, output) in enumerate(jobs, 1):
+            try:
+                report(done, path, output, _render_file(path, output), None)
+            except Exception as e:
+                report(done, path, output, [], e)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_init_worker,
+                                 initargs=(options, genomap, heatmap, query)) as pool:
+            futures = {pool.submit(_render_file, path, output): (path, output) for path, output in jobs}
+            for done, future in enumerate(as_completed(futures), 1):
+                error = future.exception()
+                report(done, *futures[future], [] if error else future.result(), error)
+    return failed
+
+def main(argv=None):
+    """Entry point for trex-batch"""
+    options = build_parser().parse_args(argv)
+    paths = tree_files(options.trees)
+    if not paths:
+        print("trex-batch: no tree files matched", file=sys.stderr)
+        return 1
+    if len(paths) == 1:
+        jobs = [(paths[0], options.tiles or options.output)]
+    elif options.tiles:
+        print("trex-batch: --tiles renders a single tree", file=sys.stderr)
+        return 1
+    else:
+        try:
+            outputs = output_paths(paths, options.outdir, options.format)
+        except ValueError as e:
+            print(f"trex-batch: {e}", file=sys.stderr)
+            return 1
+        for folder in dict.fromkeys(os.path.dirname(output) for output in outputs):
+            os.makedirs(folder, exist_ok=True)
+        jobs = list(zip(paths, outputs))
+    try:
+        # Genomap and heatmap are loaded once and shared by every tree
+        if options.query and not options.genomap:
+            raise ValueError("--query needs a genomap (-g)")
+        cache = None if options.no_cache else TableCache()
+        genomap, query = load_genomap(options.genomap, options.labels, ";".join(options.query), cache) if options.genomap else (None, None)
+        heatmap = load_heatmap(options.heatmap, options.palette, cache) if options.heatmap else None
+    except (IOError, ValueError) as e:
+        print(f"trex-batch: {e}", file=sys.stderr)
+        return 1
+    failed = render_batch(jobs, options, genomap, heatmap, query, workers=options.jobs)
+    if failed:
+        print(f"trex-batch: {len(failed)} of {len(jobs)} trees failed", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1571 @@
+# GenoMap Tree Explorer - tree and table processing
+# Shared by the GUI (TreeExplorer) and the command line renderer (TreeBatch).
+# Nothing in this module may import tkinter so that trees can be rendered headless.
+
+# Module Imports
+import os
+import re
+import sys
+import math
+import json
+import time
+import html
+import shutil
+import tempfile
+import hashlib
+import queue
+import threading
+import multiprocessing
+import importlib.util
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import cached_property, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Heavy modules are imported when first used so the GUI window opens without waiting for them
+def lazy_module(name):
+    """Module that is only imported when one of its attributes is first read"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+#Tree Exploration Imports (ete3 brings in Qt, drawing functions import the Qt classes they use)
+ete3 = lazy_module("ete3")
+#Data processing
+pd = lazy_module("pandas")
+np = lazy_module("numpy")
+
+# Heatmap colour schemes by name and code
+PALETTES: dict = {"Grayscale": 1, "Blue-Red": 2, "Red-Orange-Yellow": 3}
+
+# Colour used to highlight selected strains and default query colour
+HIGHLIGHT = "#FEE715"
+
+# Background of uncoloured nodes, the one value used so unchanged leaves are not restyled
+BACKGROUND = "#FFFFFF"
+
+# Read csv or Excel tables
+def read_table(filename, header="infer"):
+    """Load a csv or Excel file into a dataframe"""
+    if "csv" in filename:
+        return pd.read_csv(filename, encoding="ISO-8859-1", header=header)
+    return pd.read_excel(filename, header=header)
+
+# Rows read at a time when streaming csv genomaps
+CHUNK_ROWS = 250000
+
+# Column names without reading any rows
+def table_columns(filename):
+    """Header of a csv (plain or compressed) or Excel file"""
+    if "csv" in filename:
+        return pd.read_csv(filename, encoding="ISO-8859-1", nrows=0).columns.tolist()
+    return pd.read_excel(filename, nrows=0).columns.tolist()
+
+# Load selected columns of a table
+def read_columns(filename, columns, progress=None, chunksize=CHUNK_ROWS):
+    """Read only the given columns, streaming csv files in chunks and passing rows read so far to progress"""
+    if "csv" not in filename:
+        return pd.read_excel(filename, usecols=list(columns))
+    chunks, rows = [], 0
+    with pd.read_csv(filename, encoding="ISO-8859-1", usecols=list(columns), chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunks.append(chunk)
+            rows += len(chunk)
+            if progress:
+                progress(rows)
+    return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(columns))
+
+# Identify file contents for the table cache
+def file_hash(filename, block=1 << 22):
+    """Hex digest of the file contents, read in 4 MB blocks"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for data in iter(lambda: f.read(block), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+# One cached table
+class CacheEntry:
+    """Columns and arrays of one source file saved as .npy files, listed in meta.json"""
+    def __init__(self, path, source):
+        self.path = path
+        try:
+            with open(os.path.join(path, "meta.json"), "r") as f:
+                self.meta = json.load(f)
+        except (IOError, ValueError):
+            self.meta = {"source": source, "columns": None, "files": {}}
+
+    @property
+    def columns(self):
+        """Header of the source table if it has been saved"""
+        return self.meta["columns"]
+
+    def set_columns(self, columns):
+        """Save the header when every name survives JSON unchanged"""
+        if all(isinstance(col, (str, int)) and not isinstance(col, bool) for col in columns):
+            self.meta["columns"] = list(columns)
+            self.write_meta()
+
+    def write_meta(self):
+        """Write meta.json last so it only lists files that are complete"""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            temp = os.path.join(self.path, "meta.json.tmp")
+            with open(temp, "w") as f:
+                json.dump(self.meta, f)
+            os.replace(temp, os.path.join(self.path, "meta.json"))
+        except OSError:
+            pass # the cache only saves time, uploads carry on without it
+
+    def save_array(self, name, values):
+        """Save an array under a name, returning False if it could not be written"""
+        filename = hashlib.blake2b(str(name).encode(), digest_size=8).hexdigest() + ".npy" # any column name gives a safe file name
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            np.save(os.path.join(self.path, filename), np.ascontiguousarray(values), allow_pickle=False)
+        except (OSError, ValueError):
+            return False
+        self.meta["files"][str(name)] = filename
+        self.write_meta()
+        return True
+
+    def load_array(self, name):
+        """Memory mapped array saved under a name, None if not cached"""
+        filename = self.meta["files"].get(str(name))
+        if filename is None:
+            return None
+        try:
+            return np.load(os.path.join(self.path, filename), mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def save_text(self, name, strings):
+        """Save strings as UTF-8 text, so one long value does not widen every row"""
+        data = encode_text(strings)
+        return data is not None and self.save_array(name, data)
+
+    def load_text(self, name):
+        """Strings saved by save_text, None if not cached"""
+        return decode_text(self.load_array(name))
+
+    def save(self, name, column):
+        """Save a table column, numbers as they are and text as UTF-8 strings with a missing value mask"""
+        if pd.api.types.is_numeric_dtype(column.dtype) and isinstance(column.dtype, np.dtype):
+            self.save_array(name, column.to_numpy())
+            return
+        missing = column.isna().to_numpy()
+        if self.save_array(f"{name}\0missing", missing) and self.save_text(name, column.astype(str).where(~missing, "")):
+            self.meta.setdefault("dtypes", {})[str(name)] = str(column.dtype)
+            self.write_meta()
+
+    def load(self, name):
+        """Table column saved under a name, None if not cached"""
+        dtype = self.meta.get("dtypes", {}).get(str(name))
+        if dtype is None:
+            values = self.load_array(name)
+            return None if values is None else pd.Series(values, copy=False)
+        text, missing = self.load_text(name), self.load_array(f"{name}\0missing")
+        if text is None or missing is None or len(text) != len(missing): # also earlier forms or cut short, read again
+            return None
+        column = np.array(text, dtype=object)
+        column[missing] = np.nan
+        return pd.Series(column) if dtype == "object" else pd.Series(column).astype(dtype)
+
+# Strings saved without a fixed width
+def encode_text(strings):
+    """UTF-8 bytes of the strings, each ended by a NUL character, None if a string holds a NUL itself"""
+    strings = list(strings)
+    text = "\0".join(strings) + "\0" if strings else ""
+    if text.count("\0") != len(strings): # such values are read from the source instead
+        return None
+    return np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+
+def decode_text(data):
+    """Strings saved by encode_text, None if data is missing or in another form"""
+    if data is None or data.dtype != np.uint8:
+        return None
+    return data.tobytes().decode("utf-8").split("\0")[:-1]
+
+# Table cache on disk
+class TableCache:
+    """Parsed tables kept under a hash of the file contents, so a changed file is read again"""
+    def __init__(self, root=None):
+        self.root = root or os.environ.get("TREX_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "trex")
+
+    def entry(self, filename, kind):
+        """Cache entry for the current contents of a file, removing entries for its earlier contents"""
+        source = os.path.abspath(filename)
+        folder = os.path.join(self.root, kind)
+        path = os.path.join(folder, file_hash(filename))
+        if not os.path.isdir(path) and os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if CacheEntry(os.path.join(folder, name), None).meta["source"] == source:
+                    shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+        return CacheEntry(path, source)
+
+# Read a whole table through the cache
+def cached_table(filename, cache, kind, header="infer"):
+    """read_table, loading the columns from the cache when this file has been read before"""
+    entry = cache.entry(filename, kind)
+    if entry.columns is not None:
+        columns = {col: entry.load(col) for col in entry.columns}
+        if all(column is not None for column in columns.values()):
+            return pd.DataFrame(columns, copy=False)
+    df = read_table(filename, header)
+    entry.set_columns(df.columns.tolist())
+    for col in df.columns:
+        entry.save(col, df[col])
+    return df
+
+# Genomap read column by column
+class Genomap:
+    """Genomap table holding the identifier column plus the columns loaded so far, from the cache when possible"""
+    def __init__(self, filename, progress=None, cache=None):
+        self.filename = filename
+        self.entry = cache.entry(filename, "genomap") if cache is not None else None
+        if self.entry is not None and self.entry.columns is not None:
+            self.columns = self.entry.columns
+        else:
+            self.columns = table_columns(filename)
+            if self.entry is not None:
+                self.entry.set_columns(self.columns)
+        self.id = "GenomeID" if "GenomeID" in self.columns else self.columns[0]
+        self.columns = [self.id] + [col for col in self.columns if col != self.id] # identifier first, labels after
+        self.df = pd.DataFrame()
+        self.require([self.id], progress)
+
+    def require(self, columns, progress=None):
+        """Load any of the given columns not read yet and return the table"""
+        missing = [col for col in dict.fromkeys(columns) if col in self.columns and col not in self.df.columns]
+        if missing:
+            loaded = {col: self.df[col] for col in self.df.columns}
+            if self.entry is not None:
+                for col in missing:
+                    column = self.entry.load(col)
+                    if column is not None:
+                        loaded[col] = column
+            unread = [col for col in missing if col not in loaded]
+            if unread:
+                new = read_columns(self.filename, unread, progress) # rows line up as the same file is read
+                for col in unread:
+                    loaded[col] = new[col]
+                    if self.entry is not None:
+                        self.entry.save(col, new[col])
+            # identifier first, then labels in file order, without copying cached columns
+            self.df = pd.DataFrame({col: loaded[col] for col in self.columns if col in loaded}, copy=False)
+        return self.df
+
+# Genomap values as shown in tree labels
+def display_values(column):
+    """String form of a typed genomap column with missing values shown as NONE"""
+    return column.astype(str).where(column.notna(), "NONE")
+
+# Meaningful label values for the tree (e.g. Prts_1 instead of simply 1)
+def label_strings(df, column):
+    """Prefix the values of one genomap column with the column name"""
+    return str(column).replace('(','').replace(')','') + "_" + display_values(df[column])
+
+# Subset genogroups and build tree labels
+def subset_labels(df, subList, cache=None):
+    """Keep the identifier plus selected columns as label strings and join them into a Label column"""
+    # cache (one per genomap) keeps label strings per column and finished tables per selection
+    id = id_column(df)
+    columns = [col for col in subList if col != id and col in df.columns]
+    cache = {} if cache is None else cache
+    tables, strings = cache.setdefault("tables", {}), cache.setdefault("columns", {})
+    key = tuple(columns)
+    if key not in tables:
+        # Label strings are only built for the selected columns, the genomap itself stays typed
+        label = df[id].astype(str)
+        newdf = pd.DataFrame({id: label}, index=df.index)
+        for col in columns:
+            if col not in strings:
+                strings[col] = label_strings(df, col)
+            newdf[col] = strings[col]
+            label = label + " // " + strings[col] # columnar concatenation rather than a join per row
+        #create new row which will be tree label
+        newdf['Label'] = label
+        tables[key] = newdf
+    return tables[key]
+
+# Genome identifier column of a labelled dataframe
+def id_column(df):
+    """GenomeID if present otherwise the first column"""
+    return "GenomeID" if "GenomeID" in df.columns else df.columns[0]
+
+# Map genome identifiers to their labels
+def label_mapping(newdf):
+    """Genome ID to tree label dictionary"""
+    return dict(zip(newdf[id_column(newdf)].astype(str), newdf["Label"].astype(str)))
+
+# Relabel tree leaves from genome IDs
+def relabel_leaves(tree, mapping):
+    """Rename each leaf found in mapping to its label, keeping quotes and trailing comments of the newick name"""
+    def relabel(name):
+        if len(name) > 1 and name[0] == name[-1] == "'": # quoted names keep their quotes
+            key, head, tail = name[1:-1], "'", "'"
+        else:
+            key, head = name.split("[", 1)[0].rstrip(), ""
+            tail = name[len(key):] # keep whitespace and comments after the name
+        return head + mapping[key] + tail if key in mapping else None
+    tree.rename_leaves(relabel)
+    return tree
+
+# Characters replaced in names when writing newick, as ete3 does
+NEWICK_ILLEGAL = re.compile(r"[:;(),\[\]\t\n\r=]")
+
+# Array based tree used by everything except drawing
+class CompactTree:
+    """Topology, branch lengths and names of a tree held in numpy arrays, nodes numbered in preorder"""
+    def __init__(self, parent, dist, support, names, name_id):
+        self.parent = np.asarray(parent, dtype=np.int32) # -1 for the root, parents come before their children
+        self.dist = np.asarray(dist, dtype=np.float64)
+        self.support = np.asarray(support, dtype=np.float64)
+        self.names = np.asarray(names, dtype=object) # sorted unique names, as objects so one long name does not widen all
+        self.name_id = np.asarray(name_id, dtype=np.int32)
+        self.bgcolor = np.full(len(self.parent), BACKGROUND, dtype=object) # styles copied to ete3 nodes when shown
+        self.collapsed = np.zeros(len(self.parent), dtype=bool)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Compact copy of a parsed ete3 tree"""
+        nodes = list(tree.traverse("preorder"))
+        position = {id(node): i for i, node in enumerate(nodes)}
+        names, name_ids = np.unique(np.array([str(node.name) for node in nodes], dtype=object), return_inverse=True)
+        return cls([position.get(id(node.up), -1) for node in nodes], [node.dist for node in nodes],
+                   [node.support for node in nodes], names, name_ids)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __getstate__(self):
+        """Arrays and styles sent to worker processes, derived lookups are rebuilt there when needed"""
+        return dict(self.arrays(), bgcolor=self.bgcolor, collapsed=self.collapsed)
+
+    def arrays(self):
+        """Arrays needed to rebuild the tree"""
+        return {"parent": self.parent, "dist": self.dist, "support": self.support,
+                "names": self.names, "name_id": self.name_id}
+
+    @cached_property
+    def children(self):
+        """(start, order) so the children of node i are order[start[i]:start[i + 1]], in tree order"""
+        order = np.argsort(self.parent[1:], kind="stable") + 1
+        start = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[1:], minlength=len(self)), out=start[1:])
+        return start, order
+
+    @cached_property
+    def leaves(self):
+        """Leaf node numbers in tree order"""
+        start, order = self.children
+        return np.flatnonzero(start[1:] == start[:-1])
+
+    @cached_property
+    def end(self):
+        """Node number following the subtree of each node, so a subtree is the range [i, end[i])"""
+        size = [1] * len(self)
+        parent = self.parent.tolist()
+        for node in range(len(self) - 1, 0, -1):
+            size[parent[node]] += size[node]
+        return np.arange(len(self)) + np.array(size)
+
+    @cached_property
+    def depth(self):
+        """Number of branches between each node and the root"""
+        depth = [0] * len(self)
+        parent = self.parent.tolist()
+        for node in range(1, len(self)):
+            depth[node] = depth[parent[node]] + 1
+        return np.array(depth)
+
+    @cached_property
+    def leaf_counts(self):
+        """Number of leaves below each node, a leaf counting itself"""
+        return np.searchsorted(self.leaves, self.end) - np.searchsorted(self.leaves, np.arange(len(self)))
+
+    @cached_property
+    def root_distance(self):
+        """Summed branch length between each node and the root"""
+        distance = self.dist.tolist()
+        parent = self.parent.tolist()
+        distance[0] = 0.0
+        for node in range(1, len(self)):
+            distance[node] += distance[parent[node]]
+        return np.array(distance)
+
+    @cached_property
+    def leaf_index(self):
+        """Leaf name to node number, first occurrence wins as with tree & name"""
+        index = {}
+        for name, node in zip(self.leaf_names(), self.leaves.tolist()):
+            index.setdefault(name, node)
+        return index
+
+    def leaf_names(self):
+        """Names of the leaves in tree order"""
+        return self.names[self.name_id[self.leaves]].tolist()
+
+    def find(self, names):
+        """Node numbers carrying any of the given names"""
+        names = np.array([str(name) for name in names], dtype=object)
+        if not len(names) or not len(self.names):
+            return np.zeros(0, dtype=np.int64)
+        ids = np.searchsorted(self.names, names).clip(0, len(self.names) - 1)
+        return np.flatnonzero(np.isin(self.name_id, ids[self.names[ids] == names]))
+
+    def rename_leaves(self, rename):
+        """Rename the leaves for which rename(name) gives a new name, returning the number renamed"""
+        nodes, values = [], []
+        for node, name in zip(self.leaves.tolist(), self.leaf_names()):
+            value = rename(name)
+            if value is not None:
+                nodes.append(node)
+                values.append(value)
+        if nodes:
+            names, inverse = np.unique(np.concatenate([self.names, np.array([str(value) for value in values], dtype=object)]), return_inverse=True)
+            name_id = inverse[self.name_id]
+            name_id[nodes] = inverse[len(self.names):]
+            self.names, self.name_id = names, name_id.astype(np.int32)
+            self.__dict__.pop("leaf_index", None)
+        return len(nodes)
+
+    def prune(self, keep):
+        """Copy reduced to the named nodes as ete3 prune does, children of removed nodes move after their new siblings"""
+        keep = list(dict.fromkeys(keep))
+        targets = self.find(keep)
+        found, counts = np.unique(self.names[self.name_id[targets]], return_counts=True)
+        if (counts > 1).any():
+            raise ValueError(f"Ambiguous node name: {found[counts > 1][0]}")
+        if len(found) < len(keep):
+            raise ValueError(f"Node names not found: {sorted(set(keep) - set(found.tolist()))}")
+        end = self.end
+        if len(targets) == 1: # a single node keeps all of its leaves
+            targets = self.leaves[(self.leaves >= targets[0]) & (self.leaves < end[targets[0]])]
+        seeds = np.sort(targets)
+        nodes = np.arange(len(self))
+        below = np.searchsorted(seeds, end) - np.searchsorted(seeds, nodes, side="right") # targets under each node
+        kept = np.zeros(len(self), dtype=bool)
+        kept[seeds] = True
+        kept[0] = True
+        # Of a chain of nodes joining the same targets only the deepest stays, unless the chain holds a kept node
+        deepest = below >= 2
+        deepest[self.parent[1:][below[1:] == below[self.parent[1:]]]] = False
+        parent, below_list, kept_list = self.parent.tolist(), below.tolist(), kept.tolist()
+        for node in np.flatnonzero(deepest).tolist():
+            upper = node
+            while not kept_list[upper] and parent[upper] >= 0 and below_list[parent[upper]] == below_list[node]:
+                upper = parent[upper]
+            if not kept_list[upper]:
+                kept[node] = True
+        kept_nodes = np.flatnonzero(kept)
+        inside = (np.searchsorted(kept_nodes, end) > np.searchsorted(kept_nodes, nodes)).tolist() # holds a kept node
+        start, order = (values.tolist() for values in self.children)
+        kept_list = kept.tolist()
+        # Renumber kept nodes in preorder of the pruned tree
+        new_parent, new_nodes, stack = [], [], [(0, -1)]
+        while stack:
+            node, up = stack.pop()
+            position = len(new_nodes)
+            new_nodes.append(node)
+            new_parent.append(up)
+            children, pending = [], [node]
+            while pending: # children of removed nodes follow the kept children, as they are appended by ete3
+                current = pending.pop()
+                below_current = [child for child in order[start[current]:start[current + 1]] if inside[child]]
+                children.extend(child for child in below_current if kept_list[child])
+                pending.extend(reversed([child for child in below_current if not kept_list[child]]))
+            stack.extend((child, position) for child in reversed(children))
+        return CompactTree(new_parent, self.dist[new_nodes], self.support[new_nodes], self.names, self.name_id[new_nodes])
+
+    def to_nodes(self, summaries=()):
+        """ete3 nodes of the tree in preorder, the root first, with None for nodes inside summarised clades"""
+        summaries = np.asarray(summaries, dtype=np.int64)
+        hidden = np.zeros(len(self) + 1, dtype=np.int64) # +1 where a summarised clade starts hiding, -1 where it ends
+        np.add.at(hidden, summaries + 1, 1)
+        np.add.at(hidden, self.end[summaries], -1)
+        shown = np.flatnonzero(np.cumsum(hidden[:-1]) == 0)
+        names = self.names.tolist()
+        nodes = [None] * len(self)
+        for node, parent, dist, support, name_id in zip(shown.tolist(), self.parent[shown].tolist(),
+                                                        self.dist[shown].tolist(), self.support[shown].tolist(),
+                                                        self.name_id[shown].tolist()):
+            nodes[node] = ete3.Tree(name=names[name_id], dist=dist, support=support)
+            if parent >= 0:
+                nodes[parent].add_child(nodes[node])
+        return nodes
+
+    def newick(self):
+        """Newick text with internal names and branch lengths, as ete3 writes format 1"""
+        labels = [NEWICK_ILLEGAL.sub("_", name) for name in self.names.tolist()]
+        parent, end, name_id, dist = self.parent.tolist(), self.end.tolist(), self.name_id.tolist(), self.dist.tolist()
+        parts, open_nodes = [], []
+        for node in range(len(self)):
+            if node and parent[node] != node - 1: # not the first child
+                parts.append(",")
+            if end[node] > node + 1:
+                parts.append("(")
+                open_nodes.append(node)
+                continue
+            parts.append(f"{labels[name_id[node]]}:{dist[node]:0.6g}")
+            while open_nodes and end[open_nodes[-1]] == node + 1:
+                closed = open_nodes.pop()
+                parts.append(")")
+                if closed:
+                    parts.append(f"{labels[name_id[closed]]}:{dist[closed]:0.6g}")
+        parts.append(";")
+        return "".join(parts)
+
+# Binary copy of a parsed newick file, saved beside it
+TREE_CACHE_SUFFIX = ".trex.npz"
+
+def read_tree_cache(path, digest):
+    """Tree saved at path for newick text with this hash, None if missing or out of date"""
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            if str(arrays["hash"]) != digest:
+                return None
+            names = decode_text(arrays["names"]) # trees saved with fixed width names are parsed again
+            if names is None:
+                return None
+            return CompactTree(arrays["parent"], arrays["dist"], arrays["support"], names, arrays["name_id"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_tree_cache(path, digest, tree):
+    """Save the parsed tree, returning False if the location is not writable or a name holds a NUL character"""
+    names = encode_text(tree.names)
+    if names is None:
+        return False
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            np.savez(f, hash=np.array(digest), **dict(tree.arrays(), names=names))
+        os.replace(temp, path)
+        return True
+    except OSError:
+        return False
+
+# Read a newick file, parsing it only when it has changed
+def load_newick(filename, cache=None):
+    """Compact tree of the file, with a cache given it comes from its binary copy when the text is unchanged"""
+    with open(filename, "r") as f:
+        newick = f.read()
+    if cache is None:
+        return CompactTree.from_tree(ete3.Tree(newick))
+    digest = hashlib.blake2b(newick.encode(), digest_size=16).hexdigest()
+    # beside the newick file, or in the cache folder when that cannot be written to
+    places = [filename + TREE_CACHE_SUFFIX, os.path.join(cache.root, "tree", digest + ".npz")]
+    for place in places:
+        tree = read_tree_cache(place, digest)
+        if tree is not None:
+            return tree
+    tree = CompactTree.from_tree(ete3.Tree(newick))
+    for place in places:
+        if write_tree_cache(place, digest, tree):
+            break
+    return tree
+
+# Pruned views of a parsed tree
+class TreeViews:
+    """Parsed tree kept whole, with pruned copies of it cached for the most recent prune lists"""
+    def __init__(self, base, size=4):
+        self.base = base # never pruned, only styled when shown whole
+        self.size = size
+        self.cache = OrderedDict() # prune list -> (tree, state), least recently used first
+        self.state = {} # ete3 nodes and faces once the view has been shown
+
+    def get(self, prune=()):
+        """Return (tree, state) for the tree pruned to the given leaves, or the whole tree"""
+        key = frozenset(prune)
+        if not key:
+            return self.base, self.state
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            self.cache[key] = (self.base.prune(key), {})
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        return self.cache[key]
+
+    def views(self):
+        """Every tree currently held, whole tree first"""
+        return [(self.base, self.state)] + list(self.cache.values())
+
+# Generate colours for a whole heatmap at once
+def generate_colors(values, code):
+    """Return hex colour codes for a matrix of 0-1 scaled values (1: grayscale, 2: blue-red, 3: red-orange-yellow)"""
+    values = np.asarray(values, dtype=float)
+    channel = np.array([f"{i:02X}" for i in range(256)]) # two digit hex code of each channel value
+    high = (values * 255).astype(int) # truncation matches int() for values in 0-1
+    low = ((1 - values) * 255).astype(int)
+    none, full = np.zeros_like(low), np.full_like(low, 255)
+    if code == 1:
+        red, green, blue = low, low, low # white to black
+    elif code == 2:
+        red, green, blue = high, none, low # blue to red
+    else:
+        red, green, blue = full, low, none # yellow to red
+    hex_code = np.char.add(np.char.add("#", channel[red]), channel[green])
+    return np.char.add(hex_code, channel[blue])
+
+# Locate blank cells in a table
+def missing_cells(df):
+    """Return (row, column) pairs for every missing value in df"""
+    rows, cols = np.nonzero(df.isna().to_numpy())
+    return [(df.index[r], df.columns[c]) for r, c in zip(rows, cols)]
+
+# Min/max scale a heatmap table column by column
+def scale_heatmap(df):
+    """Replace presence/absence symbols and scale each column to 0-1, returning a float32 matrix"""
+    value_replacement = {"+": 1, "-": 0, "Y": 1, "N": 0} # Values replaced in df for presence/absence
+    values = np.empty(df.shape, dtype=np.float64)
+    for j, col in enumerate(df.columns):
+        column = df[col].to_numpy()
+        if not pd.api.types.is_numeric_dtype(column.dtype):
+            column = column.astype(object)
+            for k, v in value_replacement.items():
+                column[column == k] = v
+        try:
+            values[:, j] = column.astype(np.float64)
+        except (ValueError, TypeError):
+            raise ValueError(f"Column {col} contains values that are not numeric or +/-, Y/N")
+
+    # Min/Max scaling with handling for edge cases
+    df_min = values.min(axis=0)
+    df_range = values.max(axis=0) - df_min # Value difference
+    df_range[df_range == 0] = 1 # Replace zero range with 1 to avoid zero div errors
+    values = (values - df_min) / df_range
+
+    # Handle case when all values are 1 to avoid NaN being generated
+    if (values == 1).all():
+        values[:] = 0
+    return values.astype(np.float32)
+
+# Scaled heatmaps kept in the table cache
+def cached_heatmap(entry):
+    """(rows, columns, values) saved for this heatmap file, None if it has not been scaled before"""
+    rows, values = entry.load_text("rows"), entry.load_array("scaled")
+    if rows is None or values is None or entry.columns is None or len(rows) != len(values):
+        return None
+    return rows, list(entry.columns), values
+
+def cache_heatmap(entry, rows, columns, values):
+    """Save a scaled heatmap, the header is written last so only complete heatmaps are found"""
+    if entry.save_text("rows", [str(row) for row in rows]) and entry.save_array("scaled", values):
+        entry.set_columns(columns)
+
+# Label search language
+#   rule[; rule ...]        several rules in one search, the first matching rule colours a leaf
+#   expression -> colour    colour for the rule (legacy form: expression AND colour=X)
+#   expression              comparisons combined with AND, OR, NOT and parentheses
+#   comparison              label op value with op one of = == != < <= > >=
+#                           legacy forms label_value and label=(L,x), (G,x), (x,y) are also accepted
+QUERY_TOKEN = re.compile(r"""\s*(?:(?P<range>\([^()]*,[^()]*\))|(?P<lpar>\()|(?P<rpar>\))|(?P<arrow>->)
+                             |(?P<op>>=|<=|!=|==|=|<|>)|(?P<word>"[^"]*"|'[^']*'|(?:[^\s()<>=!"'-]|-(?!>))+))""", re.X)
+QUERY_KEYWORDS = ("AND", "OR", "NOT")
+COLOUR_KEYS = ("COLOUR", "COLOR", "COL")
+
+# Accepted keywords for (L,x) and (G,x) range queries
+ACCEPTED_LESS = ("L", "LESS", "LESS THAN", "LT", "LOWER", "BELOW", "LESSTHAN", "UNDER")
+ACCEPTED_MORE = ("G", "GREATER", "GREATER THAN", "GT", "HIGHER", "MORE", "ABOVE", "GREATERTHAN")
+
+# Split query text into (kind, text) tokens
+def tokenize_query(text):
+    """Tokens of one query rule, raising ValueError on characters that cannot be read"""
+    tokens, pos = [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = QUERY_TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f"Cannot read query from '{text[pos:].strip()}'")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "word" and value.upper() in QUERY_KEYWORDS:
+            kind, value = value.upper(), value.upper()
+        elif kind == "word" and value[0] in "\"'":
+            value = value[1:-1] # quoted labels or values may contain spaces or symbols
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+# Colour given as the last AND term of a legacy query (yellow, colour=yellow, colour_yellow)
+def legacy_colour(tokens, names):
+    """Colour named by tokens if they are a colour term rather than a comparison"""
+    words = [value for kind, value in tokens if kind == "word"]
+    if len(tokens) == 3 and tokens[1] == ("op", "=") and words and words[0].upper() in COLOUR_KEYS:
+        return tokens[2][1]
+    if len(tokens) == 1 and words:
+        word = words[0]
+        key, _, colour = word.partition("_")
+        if colour and key.upper() in COLOUR_KEYS:
+            return colour
+        if not any(word.upper().startswith(name + "_") for name in names):
+            return word
+    return None
+
+# Recursive descent parser producing nested tuples
+class QueryParser:
+    """Parse one rule into ("or"|"and", left, right), ("not", expr) and ("cmp", column, op, operand) tuples"""
+    def __init__(self, tokens, names):
+        self.tokens, self.pos, self.names = tokens, 0, names
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Empty search")
+        expr = self.expression()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected '{self.tokens[self.pos][1]}' in search")
+        return expr
+
+    def expression(self):
+        expr = self.term()
+        while self.peek() == "OR":
+            self.take()
+            expr = ("or", expr, self.term())
+        return expr
+
+    def term(self):
+        expr = self.factor()
+        while self.peek() == "AND":
+            self.take()
+            expr = ("and", expr, self.factor())
+        return expr
+
+    def factor(self):
+        kind = self.peek()
+        if kind == "NOT":
+            self.take()
+            return ("not", self.factor())
+        if kind == "lpar":
+            self.take()
+            expr = self.expression()
+            if self.peek() != "rpar":
+                raise ValueError("Missing ')' in search")
+            self.take()
+            return expr
+        return self.comparison()
+
+    def words(self):
+        words = []
+        while self.peek() == "word":
+            words.append(self.take()[1])
+        return " ".join(words)
+
+    def comparison(self):
+        label = self.words()
+        if not label:
+            found = self.tokens[self.pos][1] if self.pos < len(self.tokens) else "end of search"
+            raise ValueError(f"Expected a label before '{found}'")
+        if self.peek() != "op": # legacy label_value
+            name = max((name for name in self.names if label.upper().startswith(name + "_")), key=len, default=None)
+            if name is None:
+                raise ValueError(f"No genomap column matches '{label}'")
+            return ("cmp", self.names[name], "==", label[len(name) + 1:])
+        op = self.take()[1]
+        column = self.names.get(label.upper())
+        if column is None:
+            raise ValueError(f"No genomap column matches '{label}'")
+        if self.peek() == "range":
+            return ("cmp", column) + range_predicate(self.take()[1], op, label)
+        value = self.words()
+        if not value:
+            raise ValueError(f"Missing value after '{label}{op}'")
+        op = "==" if op == "=" else op
+        if op not in ("==", "!="):
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError(f"'{label}{op}{value}' needs a number")
+        return ("cmp", column, op, value)
+
+# Convert the legacy (L,x), (G,x) and (x,y) notation
+def range_predicate(text, op, label):
+    """(operator, operand) for a bracketed range"""
+    bounds = [i.strip() for i in text.strip("()").split(",")]
+    try:
+        if op != "=" or len(bounds) != 2:
+            raise ValueError
+        if bounds[0].upper() in ACCEPTED_LESS:
+            return ("<", float(bounds[1]))
+        if bounds[0].upper() in ACCEPTED_MORE:
+            return (">=", float(bounds[1]))
+        return ("range", (float(bounds[0]), float(bounds[1])))
+    except ValueError:
+        raise ValueError(f"Range '{label}{op}{text}' is not of the form (L,x), (G,x) or (x,y)")
+
+# Compile a search once into typed rules
+def compile_query(value, columns):
+    """Parse a label search into a list of (expression, colour) rules"""
+    # Labels are matched without case or brackets
+    names = {str(col).replace('(','').replace(')','').upper(): col for col in columns}
+    rules = []
+    for text in re.split(r"[;\n]", value):
+        if not text.strip():
+            continue
+        tokens = tokenize_query(text)
+        arrows = [i for i, token in enumerate(tokens) if token[0] == "arrow"]
+        if arrows:
+            colour = " ".join(value for _, value in tokens[arrows[-1] + 1:])
+            if not colour:
+                raise ValueError(f"Missing colour after '->' in '{text.strip()}'")
+            tokens = tokens[:arrows[-1]]
+        else:
+            # Legacy form: the final top level AND term names the colour
+            colour, depth, last = None, 0, None
+            for i, (kind, _) in enumerate(tokens):
+                depth += (kind == "lpar") - (kind == "rpar")
+                if kind == "AND" and depth == 0:
+                    last = i
+            if last is not None:
+                colour = legacy_colour(tokens[last + 1:], names)
+                if colour is not None:
+                    tokens = tokens[:last]
+            colour = colour or HIGHLIGHT
+        rules.append((QueryParser(tokens, names).parse(), colour))
+    if not rules:
+        raise ValueError("Empty search")
+    return rules
+
+# Genomap columns used by compiled search rules
+def query_columns(rules):
+    """Column names compared in the rules, in order of first use"""
+    columns = []
+    stack = [expr for expr, colour in reversed(rules)]
+    while stack:
+        expr = stack.pop()
+        if expr[0] == "cmp":
+            columns.append(expr[1])
+        else:
+            stack.extend(reversed(expr[1:]))
+    return list(dict.fromkeys(columns))
+
+# Evaluate a compiled expression over the genomap
+def query_mask(df, expr, cache=None):
+    """Boolean array of genomap rows meeting the expression"""
+    cache = {} if cache is None else cache # column values are converted once per search
+    if expr[0] == "and":
+        return query_mask(df, expr[1], cache) & query_mask(df, expr[2], cache)
+    if expr[0] == "or":
+        return query_mask(df, expr[1], cache) | query_mask(df, expr[2], cache)
+    if expr[0] == "not":
+        return ~query_mask(df, expr[1], cache)
+    _, column, op, operand = expr
+    if column not in cache: # typed columns are compared directly, text is only converted when needed
+        if pd.api.types.is_numeric_dtype(df[column].dtype) and not pd.api.types.is_bool_dtype(df[column].dtype):
+            numbers = df[column].to_numpy(dtype=float, na_value=np.nan)
+        else:
+            numbers = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        cache[column] = [None, numbers] # NaN never compares True
+    numbers = cache[column][1]
+    if op in ("==", "!="):
+        try:
+            number = float(operand)
+        except ValueError:
+            number = None
+        if number is not None and not np.isnan(number) and pd.api.types.is_numeric_dtype(df[column].dtype):
+            test = numbers == number # 1 also matches 1.0
+        else:
+            if cache[column][0] is None:
+                cache[column][0] = display_values(df[column]).str.upper().to_numpy(dtype=object)
+            test = cache[column][0] == operand.upper()
+            if number is not None:
+                test |= numbers == number
+        return ~test if op == "!=" else test
+    if op == "<":
+        return numbers < operand
+    if op == "<=":
+        return numbers <= operand
+    if op == ">":
+        return numbers > operand
+    if op == ">=":
+        return numbers >= operand
+    return (numbers >= operand[0]) & (numbers <= operand[1])
+
+# Colour leaves matching compiled search rules
+def colour_query(tree, reference, df, rules, rows=None):
+    """Colour leaves by the first rule their genomap row matches and clear the rest, returning the match count.
+    rows are the leaf_rows of the tree, which can be kept between searches"""
+    cache = {}
+    colours = np.full(len(df), None, dtype=object)
+    for expr, colour in reversed(rules): # earlier rules take priority
+        colours[query_mask(df, expr, cache)] = colour
+    leaves, rows = rows if rows is not None else leaf_rows(tree.leaf_index, reference, df)
+    colours = colours[rows]
+    hits = colours != None
+    tree.bgcolor[tree.leaves] = BACKGROUND
+    tree.bgcolor[leaves[hits]] = colours[hits]
+    return int(np.count_nonzero(hits))
+
+# Genomap row of each leaf
+def leaf_rows(leafIndex, reference, df):
+    """Node numbers of the leaves found in the genomap and the position of their row"""
+    ids = df[id_column(df)].astype(str).tolist()
+    position = {reference.get(i, i): row for row, i in enumerate(ids)} # genome IDs to tree labels
+    pairs = [(leaf, position[name]) for name, leaf in leafIndex.items() if name in position]
+    leaves, rows = np.array(pairs, dtype=np.int64).reshape(-1, 2).T
+    return leaves, rows
+
+# Collapse branches containing selected strains
+def collapse_branches(tree, depth, collapseList):
+    """Close nodes at the given depth whose leaves include a selected strain, returning the closed nodes"""
+    selected = np.intersect1d(tree.find(collapseList), tree.leaves) # sorted, as subtrees are ranges of node numbers
+    level = np.flatnonzero(tree.depth == depth) # leaves above the collapse depth are left open
+    closed = level[np.searchsorted(selected, tree.end[level]) > np.searchsorted(selected, level)]
+    tree.collapsed[closed] = True
+    return closed
+
+# Leaf nodes for selected strains
+def strain_leaves(leafIndex, strainList, reference):
+    """Resolve strain IDs or labels to leaf node numbers, each node once and unknown strains skipped"""
+    nodes = (leafIndex.get(reference.get(strain, strain)) for strain in strainList) # labels may have been modified
+    return list(dict.fromkeys(node for node in nodes if node is not None))
+
+# Colour strains in subset list
+def colour_strains(tree, strainList, reference):
+    """Highlight the leaves of selected strains, returning the number found in the tree"""
+    nodes = strain_leaves(tree.leaf_index, strainList, reference)
+    tree.bgcolor[nodes] = HIGHLIGHT
+    return len(nodes)
+
+# Search index over strain identifiers
+class StrainIndex:
+    """Sorted strain IDs searched by prefix with bisect, then by substring over one joined string"""
+    def __init__(self, ids):
+        pairs = sorted((name.upper(), name) for name in dict.fromkeys(map(str, ids)))
+        self.keys = [key for key, name in pairs]
+        self.names = [name for key, name in pairs]
+        self.starts = [] # offset of each key in the joined string
+        offset = 0
+        for key in self.keys:
+            self.starts.append(offset)
+            offset += len(key) + 1
+        self.joined = "\n".join(self.keys)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, text):
+        """Yield IDs starting with the text, then other IDs containing it, case insensitive"""
+        text = text.strip().upper()
+        first = last = bisect_left(self.keys, text)
+        while last < len(self.keys) and self.keys[last].startswith(text):
+            yield self.names[last]
+            last += 1
+        if not text or "\n" in text:
+            return
+        position = self.joined.find(text)
+        while position != -1:
+            row = bisect_right(self.starts, position) - 1
+            if not first <= row < last: # prefix matches were listed already
+                yield self.names[row]
+            if row + 1 == len(self.starts):
+                return
+            position = self.joined.find(text, self.starts[row + 1])
+
+# Split pasted or uploaded text into strain identifiers
+ID_SEPARATOR = re.compile(r"[\r\n,;\t]+")
+
+def parse_ids(text):
+    """Identifiers separated by new lines, commas, semicolons or tabs, in order and without repeats"""
+    return list(dict.fromkeys(item.strip() for item in ID_SEPARATOR.split(text) if item.strip()))
+
+# Read a strain list file
+def read_ids(filename):
+    """Identifiers from a text file, or from the first column of a csv/Excel table"""
+    if "csv" in filename or "xls" in filename:
+        column = read_table(filename, header=None).iloc[:, 0]
+        return parse_ids("\n".join(column[column.notna()].astype(str)))
+    with open(filename, "r", encoding="ISO-8859-1") as f:
+        return parse_ids(f.read())
+
+# Style the tree with basic features
+def tree_style(mode="r"):
+    """Tree style shared by interactive display and rendered output"""
+    ts = ete3.TreeStyle()
+    ts.mode = mode
+    ts.show_leaf_name = False
+    ts.branch_vertical_margin = 50
+    ts.scale = 150
+    return ts
+
+# Node styling and leaf names
+def style_nodes(tree):
+    """Hide default node shapes and add tip names in a custom position"""
+    for node in tree.traverse():
+        # disable default node shapes
+        node.img_style["size"] = 0
+        node.img_style["shape"] = "sphere"
+        node.img_style["fgcolor"] = "black"
+        # Add tip names in a custom position
+        if node.is_leaf():
+            nameF = ete3.TextFace(node.name, fsize=30, fgcolor="slateGrey")
+            node.add_face(nameF, column=1, position="branch-right")
+
+# Copy colours and collapsed branches onto the ete3 nodes
+def apply_styles(nodes, tree, summaries=(), applied=None):
+    """Set background colour and descendant drawing of the drawn ete3 nodes from the compact tree, returning the
+    number of nodes restyled. The applied dict remembers what was set so later calls only touch changed nodes"""
+    if applied:
+        dirty = np.flatnonzero((tree.bgcolor != applied["bgcolor"]) | (tree.collapsed != applied["collapsed"]))
+    else:
+        dirty = np.arange(len(tree))
+    for node, colour, collapsed in zip(dirty.tolist(), tree.bgcolor[dirty].tolist(), tree.collapsed[dirty].tolist()):
+        if nodes[node] is not None:
+            nodes[node].img_style["bgcolor"] = colour
+            nodes[node].img_style["draw_descendants"] = not collapsed
+    # Summarised clades show the most common colour of their leaves so highlighted strains stay visible
+    summaries = np.asarray(summaries, dtype=np.int64)
+    changed = np.searchsorted(dirty, tree.end[summaries]) > np.searchsorted(dirty, summaries) # subtrees are ranges
+    for clade in summaries[changed].tolist():
+        colours = tree.bgcolor[tree.leaves[clade_leaves(tree, clade)]]
+        colours = colours[colours != BACKGROUND].astype(str)
+        if len(colours):
+            values, counts = np.unique(colours, return_counts=True)
+            nodes[clade].img_style["bgcolor"] = values[counts.argmax()]
+        else:
+            nodes[clade].img_style["bgcolor"] = tree.bgcolor[clade]
+    if applied is not None:
+        applied.update(bgcolor=tree.bgcolor.copy(), collapsed=tree.collapsed.copy())
+    return len(dirty)
+
+# Level of detail: clades drawn shorter than this many pixels are summarised
+DETAIL_PIXELS = 10
+
+# Leaves of a clade
+def clade_leaves(tree, clade):
+    """Slice of tree.leaves holding the leaves below a node, which are consecutive in preorder"""
+    return slice(np.searchsorted(tree.leaves, clade), np.searchsorted(tree.leaves, tree.end[clade]))
+
+# Choose the clades drawn as summaries
+def detail_clades(tree, rows):
+    """Largest clades to summarise so that at most rows leaves and summaries are drawn, none if every leaf fits"""
+    counts = tree.leaf_counts
+    if counts[0] <= rows:
+        return np.zeros(0, dtype=np.int64)
+    above = np.append(np.iinfo(np.int64).max, counts[tree.parent[1:]]) # the root has nothing above it
+    def drawn(size): # clades of at most size leaves whose parent is larger are drawn as one row
+        return np.count_nonzero((counts <= size) & (above > size))
+    low, high = 1, int(counts[0]) # the smallest clade size that fits, drawn() only falls as size grows
+    while low < high:
+        middle = (low + high) // 2
+        if drawn(middle) <= rows:
+            high = middle
+        else:
+            low = middle + 1
+    return np.flatnonzero((counts <= low) & (above > low) & (counts > 1))
+
+# Collapsed clade drawn as a triangle, defined on first use as it is built on an ete3 face
+@lru_cache(maxsize=None)
+def triangle_face():
+    """TriangleFace class, created the first time a summarised clade is drawn"""
+    from ete3.treeview.qt import QGraphicsPolygonItem, QPolygonF, QPointF, QBrush, QPen, QColor
+
+    class TriangleFace(ete3.DiamondFace):
+        """Triangle pointing back to the parent branch, as wide as the clade is deep"""
+        def update_items(self):
+            self.item = QGraphicsPolygonItem(QPolygonF([QPointF(0, self.height / 2.0), QPointF(self.width, 0),
+                                                        QPointF(self.width, self.height)]))
+            self.item.setBrush(QBrush(QColor(self.color)))
+            self.item.setPen(QPen(QColor(self.color)))
+    return TriangleFace
+
+# Label and draw summarised clades
+def summarise_clades(nodes, tree, summaries, scale=150):
+    """Name each summarised clade by its leaf count and most common genomap labels and add a triangle face"""
+    names = tree.leaf_names()
+    for clade in summaries:
+        span = clade_leaves(tree, clade)
+        leaves = tree.leaves[span]
+        text = f"{len(leaves)} leaves"
+        labels = [name.split(" // ")[1:] for name in names[span]] # genomap columns without the genome ID
+        for column in zip(*labels): # most common value of each label column
+            values, counts = np.unique(column, return_counts=True)
+            text += f" // {values[counts.argmax()]} ({counts.max() / len(leaves):.0%})"
+        depth = (tree.root_distance[leaves] - tree.root_distance[clade]).max()
+        height = 30 * (1 + np.log10(len(leaves)))
+        nodes[clade].name = text # tip name face shows the summary
+        nodes[clade].add_face(triangle_face()(max(depth * scale, height / 2), height, color="slateGrey"),
+                              column=0, position="branch-right")
+
+# Heatmap rows matched to leaves
+def heatmap_leaves(leafIndex, reference, rows):
+    """Pairs of (leaf node number, heatmap row) and the number of rows without a matching leaf"""
+    pairs = []
+    for row, name in enumerate(rows): # row by row so each leaf is looked up once
+        node = leafIndex.get(reference.get(str(name), str(name))) # IDs may carry genomap labels
+        if node is not None:
+            pairs.append((node, row))
+    return pairs, len(rows) - len(pairs)
+
+# Building the heatmap
+def add_heatmap(nodes, pairs, values, colours, value_only=False):
+    """Attach heatmap faces to the ete3 nodes of matched leaves that are drawn"""
+    colours = colours.tolist()
+    for node, row in pairs:
+        leaf_node = nodes[node]
+        if leaf_node is None: # inside a summarised clade
+            continue
+        for column, value in enumerate(values[row]):
+            color = colours[row][column]
+            if value_only:
+                value_face = ete3.TextFace(text=f'{value:.2f}_', fsize=5, fgcolor=color, bold=True) # limit values to 2 SF otherwise display is crowded
+                leaf_node.add_face(value_face, column=column, position="aligned")
+            else:
+                rect_face = ete3.RectFace(width=30, height=30, fgcolor="black", bgcolor=color, label="X")
+                leaf_node.add_face(rect_face, column=column, position="aligned")
+
+# Add label for each heatmap column as a header
+def add_heatmap_header(ts, columns):
+    """Rotated column names above the aligned heatmap"""
+    for column, name in enumerate(columns):
+        column_label = ete3.TextFace(f"{name}", fsize=10) # Retrieve col name by index
+        column_label.rotation = 90 # Rotate the label by 90 degrees
+        ts.aligned_header.add_face(column_label, column=column)
+
+# Styled tree sent to drawing processes
+class TreeDrawing:
+    """Compact tree with its summaries, heatmap and style options, from which the ete3 nodes are built where the tree is
+    drawn. ete3 trees are pickled recursively, which fails on deep trees, so only arrays cross to worker processes"""
+    def __init__(self, tree, summaries=(), heatmap=None, mode="r", header=()):
+        self.tree = tree
+        self.summaries = np.asarray(summaries, dtype=np.int64)
+        self.heatmap = heatmap # (leaf and row pairs, values, colours, value_only) or None
+        self.mode = mode
+        self.header = list(header) # heatmap column names, empty for none
+
+    def build(self):
+        """Styled ete3 root node and tree style"""
+        nodes = self.tree.to_nodes(self.summaries)
+        summarise_clades(nodes, self.tree, self.summaries)
+        style_nodes(nodes[0])
+        apply_styles(nodes, self.tree, self.summaries)
+        if self.heatmap is not None:
+            add_heatmap(nodes, *self.heatmap)
+        ts = tree_style(self.mode)
+        add_heatmap_header(ts, self.header)
+        return nodes[0], ts
+
+# Qt scene of a styled tree
+def tree_scene(tree, ts):
+    """Lay the styled tree out as a Qt scene, as ete3 does before saving an image"""
+    from ete3.treeview.drawer import init_scene
+    from ete3.treeview.qt4_render import render as render_scene
+    for nid, node in enumerate(tree.traverse("preorder")):
+        node.add_feature("_nid", nid)
+    scene, img = init_scene(tree, None, ts)
+    tree_item, n2i, n2f = render_scene(tree, img)
+    scene.init_values(tree, img, n2i, n2f)
+    tree_item.setParentItem(scene.master_item)
+    scene.master_item.setPos(0, 0)
+    scene.addItem(scene.master_item)
+    return scene
+
+# Scene items drawn as SVG elements, items that only hold other items draw nothing
+SVG_GROUPS = {"_EmptyItem", "_NodeItem", "_FaceGroupItem", "_BackgroundFaceItem"}
+SVG_SHAPES = {"QGraphicsRectItem": "rect", "_TreeItem": "rect", "_RectItem": "rect", "QGraphicsLineItem": "line",
+              "_LineItem": "line", "_NodeLineItem": "line", "QGraphicsSimpleTextItem": "text", "_TextFaceItem": "text",
+              "QGraphicsPolygonItem": "polygon", "QGraphicsEllipseItem": "ellipse", "_CircleItem": "ellipse",
+              "QGraphicsPathItem": "path", "_ArcItem": "path"}
+
+def svg_number(value):
+    """Coordinate with two decimals and no trailing zeros"""
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+def svg_colour(prop, colour):
+    """CSS colour declaration with opacity only when the colour is see-through"""
+    alpha = colour.alphaF()
+    return f"{prop}:{colour.name()}" + (f";{prop}-opacity:{alpha:.3g}" if alpha < 1 else "")
+
+def svg_fill(brush):
+    """CSS fill of a Qt brush, gradients are filled with their last colour"""
+    from ete3.treeview.qt import Qt
+    if brush.style() == Qt.NoBrush:
+        return "fill:none"
+    gradient = brush.gradient()
+    return svg_colour("fill", gradient.stops()[-1][1] if gradient is not None and gradient.stops() else brush.color())
+
+def svg_stroke(pen):
+    """CSS stroke of a Qt pen, cosmetic pens stay one pixel wide when the drawing is scaled"""
+    from ete3.treeview.qt import Qt
+    if pen.style() == Qt.NoPen:
+        return "stroke:none"
+    dashes = {Qt.DashLine: (4, 2), Qt.DotLine: (1, 2), Qt.DashDotLine: (4, 2, 1, 2), Qt.DashDotDotLine: (4, 2, 1, 2, 1, 2)}
+    caps = {Qt.FlatCap: "butt", Qt.SquareCap: "square", Qt.RoundCap: "round"}
+    joins = {Qt.MiterJoin: "miter", Qt.BevelJoin: "bevel", Qt.RoundJoin: "round", Qt.SvgMiterJoin: "miter"}
+    width = pen.widthF() or 1.0
+    style = f"{svg_colour('stroke', pen.color())};stroke-width:{svg_number(width)}"
+    style += f";stroke-linecap:{caps.get(pen.capStyle(), 'square')};stroke-linejoin:{joins.get(pen.joinStyle(), 'bevel')}"
+    if pen.style() in dashes:
+        style += ";stroke-dasharray:" + ",".join(svg_number(step * width) for step in dashes[pen.style()])
+    if pen.isCosmetic() or not pen.widthF():
+        style += ";vector-effect:non-scaling-stroke"
+    return style
+
+def svg_font(font):
+    """CSS font of a Qt font, sized in pixels as the scene was laid out"""
+    from ete3.treeview.qt import QApplication
+    size = font.pixelSize() if font.pixelSize() > 0 else font.pointSizeF() * QApplication.primaryScreen().logicalDotsPerInchY() / 72
+    family = font.family().replace("'", "")
+    return (f"font-family:'{family}';font-size:{svg_number(size)}px" + (";font-weight:bold" if font.bold() else "")
+            + (";font-style:italic" if font.italic() else ""))
+
+def svg_text(x, y, font, text, style):
+    """Text lines of a Qt text item drawn from its top left corner"""
+    from PyQt5.QtGui import QFontMetricsF
+    metrics = QFontMetricsF(font)
+    return "".join(f'<text class="{style}" x="{svg_number(x)}" y="{svg_number(y + metrics.ascent() + row * metrics.height())}">'
+                   f'{html.escape(line, quote=False)}</text>' for row, line in enumerate(text.split("\n")))
+
+def svg_rect_label(item):
+    """Style, text and baseline position of a RectFace label, as ete3 paints it"""
+    from ete3.treeview.qt import QFont, QFontMetrics, QRect, QColor, Qt
+    label = item.label
+    font = QFont(label.get("font", "Verdana"), int(label.get("fontsize", 12)))
+    box = QFontMetrics(font).boundingRect(QRect(), Qt.AlignCenter, label.get("text", "No label text!"))
+    rect = item.boundingRect()
+    return (svg_font(font) + ";" + svg_colour("fill", QColor(label["color"])), label.get("text", "No label text!"),
+            int(rect.width() / 2 - box.width() / 2), int(rect.height() / 2 + box.height() / 2))
+
+def svg_rect(x, y, width, height, style, label, classes):
+    """Rectangle with its optional RectFace label"""
+    rect = (f'<rect class="{classes[style]}" x="{svg_number(x)}" y="{svg_number(y)}" width="{svg_number(width)}" '
+            f'height="{svg_number(height)}"/>')
+    if label is None:
+        return rect
+    text_style, text, left, base = label
+    return (f'{rect}<text class="{classes[text_style]}" x="{svg_number(x + left)}" y="{svg_number(y + base)}">'
+            f'{html.escape(text, quote=False)}</text>')
+
+def svg_items(scene):
+    """(kind, styles, geometry, transform) of each drawn scene item in painting order, raising ValueError on items
+    that cannot be written as SVG elements"""
+    from ete3.treeview.qt import Qt
+    # Heatmaps repeat a handful of styles many thousand times, so each style is formatted once
+    cache = {}
+    def cached(key, make, value):
+        if key not in cache:
+            cache[key] = make(value)
+        return cache[key]
+    def fill(brush):
+        return cached(("fill", brush.style(), brush.color().rgba()), svg_fill, brush)
+    def stroke(pen):
+        return cached(("stroke", pen.style(), pen.color().rgba(), pen.widthF(), pen.capStyle(), pen.joinStyle(),
+                       pen.isCosmetic()), svg_stroke, pen)
+    def font(value):
+        return cached(("font", value.key()), svg_font, value)
+    for item in scene.items(Qt.AscendingOrder):
+        name = type(item).__name__
+        if name in SVG_GROUPS or item.flags() & item.ItemHasNoContents or not item.isVisible():
+            continue
+        kind = SVG_SHAPES.get(name)
+        if kind is None or (getattr(item, "label", None) and name != "_RectItem"):
+            raise ValueError(f"{name} items cannot be written as SVG")
+        matrix = item.sceneTransform()
+        if matrix.type() <= matrix.TxTranslate: # positions are moved instead of adding a transform
+            dx, dy, transform = matrix.dx(), matrix.dy(), None
+        else:
+            dx, dy = 0.0, 0.0
+            transform = "matrix(" + " ".join(svg_number(value) if index > 3 else f"{value:.6g}" for index, value in
+                                             enumerate((matrix.m11(), matrix.m12(), matrix.m21(), matrix.m22(),
+                                                        matrix.dx(), matrix.dy()))) + ")"
+        opacity = item.effectiveOpacity()
+        styles = [] if opacity >= 1 else [f"opacity:{opacity:.3g}"]
+        if kind == "text":
+            styles += [font(item.font()), fill(item.brush()), stroke(item.pen())]
+            geometry = (dx, dy, item.font(), item.text())
+        elif kind == "line":
+            line = item.line()
+            styles.append(stroke(item.pen()))
+            geometry = (line.x1() + dx, line.y1() + dy, line.x2() + dx, line.y2() + dy)
+        else:
+            styles += [fill(item.brush()), stroke(item.pen())]
+            if kind == "rect":
+                rect = item.rect()
+                if rect.width() <= 0 or rect.height() <= 0:
+                    continue
+                label = cached(("label", tuple(item.label.items()), rect.width(), rect.height()), svg_rect_label, item) \
+                    if getattr(item, "label", None) else None
+                if label is None and styles[-2:] == ["fill:none", "stroke:none"]: # frames that only hold faces
+                    continue
+                geometry = (rect.x() + dx, rect.y() + dy, rect.width(), rect.height(), label)
+            elif kind == "ellipse":
+                if item.spanAngle() != 5760:
+                    raise ValueError("Ellipse segments cannot be written as SVG")
+                rect = item.rect()
+                geometry = (rect.center().x() + dx, rect.center().y() + dy, rect.width() / 2, rect.height() / 2)
+            elif kind == "polygon":
+                geometry = " ".join(f"{svg_number(point.x() + dx)},{svg_number(point.y() + dy)}" for point in item.polygon())
+            else:
+                path = item.path()
+                steps = []
+                for index in range(path.elementCount()):
+                    element = path.elementAt(index)
+                    command = {0: "M", 1: "L", 2: "C"}.get(element.type, "")
+                    steps.append(f"{command}{svg_number(element.x + dx)},{svg_number(element.y + dy)}")
+                geometry = " ".join(steps)
+        yield kind, ";".join(styles), geometry, transform
+
+# Write the scene as SVG, sharing styles and repeated shapes
+def write_svg(scene, filename, w=None, h=None):
+    """Stream the scene to an SVG file with each style and each repeated rectangle, such as heatmap cells, defined once"""
+    # Elements go to a temporary file as they are produced, so only the styles and rectangle shapes are held. They are
+    # written at the top once every item has been seen and the elements are copied after them
+    classes, shapes, seen = {}, {}, set()
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as body:
+        for kind, style, geometry, transform in svg_items(scene):
+            name = classes.setdefault(style, f"s{len(classes)}")
+            if kind == "rect":
+                x, y, width, height, label = geometry
+                if label is not None:
+                    classes.setdefault(label[0], f"s{len(classes)}")
+                shape = (width, height, style, label)
+                if shape in seen: # repeats use the first one, defined with the styles
+                    element = (f'<use xlink:href="#{shapes.setdefault(shape, f"r{len(shapes)}")}" '
+                               f'x="{svg_number(x)}" y="{svg_number(y)}"/>')
+                else:
+                    seen.add(shape)
+                    element = svg_rect(x, y, *shape, classes)
+            elif kind == "text":
+                element = svg_text(*geometry[:2], geometry[2], geometry[3], name)
+            elif kind == "line":
+                element = (f'<line class="{name}" x1="{svg_number(geometry[0])}" y1="{svg_number(geometry[1])}" '
+                           f'x2="{svg_number(geometry[2])}" y2="{svg_number(geometry[3])}"/>')
+            elif kind == "ellipse":
+                element = (f'<ellipse class="{name}" cx="{svg_number(geometry[0])}" cy="{svg_number(geometry[1])}" '
+                           f'rx="{svg_number(geometry[2])}" ry="{svg_number(geometry[3])}"/>')
+            elif kind == "polygon":
+                element = f'<polygon class="{name}" points="{geometry}"/>'
+            else:
+                element = f'<path class="{name}" d="{geometry}"/>'
+            if transform is not None:
+                element = f'<g transform="{transform}">{element}</g>'
+            body.write(element + "\n")
+        rect = scene.sceneRect()
+        w, h = w or rect.width(), h or rect.height()
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                    f'width="{svg_number(w)}" height="{svg_number(h)}" viewBox="{svg_number(rect.x())} {svg_number(rect.y())} '
+                    f'{svg_number(rect.width())} {svg_number(rect.height())}" preserveAspectRatio="none">\n<style>\n')
+            f.writelines(f".{name}{{{style}}}\n" for style, name in classes.items())
+            f.write("</style>\n<defs>\n")
+            for shape, name in shapes.items():
+                f.write(f'<g id="{name}">{svg_rect(0, 0, *shape, classes)}</g>\n')
+            f.write(f'</defs>\n<rect x="{svg_number(rect.x())}" y="{svg_number(rect.y())}" width="{svg_number(rect.width())}" '
+                    f'height="{svg_number(rect.height())}" fill="#FFFFFF"/>\n')
+            body.seek(0)
+            shutil.copyfileobj(body, f)
+            f.write("</svg>\n")
+
+# Write tree image to file
+def render_tree(tree, ts, filename, w=1200, h=800, equalize_branch=False):
+    """Render the styled tree to an image file, returning the file size in bytes and the seconds taken"""
+    # SVG is written by write_svg unless the tree holds faces it cannot draw, PDF and PNG are drawn by Qt
+    start = time.perf_counter()
+    nodes = list(tree.traverse()) if equalize_branch else []
+    lengths = [node.dist for node in nodes]
+    for node in nodes:
+        node.dist = 1.0
+    try:
+        if filename.lower().endswith(".svg"):
+            try:
+                write_svg(tree_scene(tree, ts), filename, w, h)
+            except ValueError: # faces without an SVG form are drawn by Qt
+                tree.render(filename, w=w, h=h, units="px", tree_style=ts)
+        else:
+            tree.render(filename, w=w, h=h, units="px", tree_style=ts) # write tree to file
+    finally:
+        for node, dist in zip(nodes, lengths): # branch lengths are kept for later views and exports
+            node.dist = dist
+    return os.path.getsize(filename), time.perf_counter() - start
+
+# Draw a TreeDrawing to file, in a worker process
+def render_drawing(drawing, filename, w=1200, h=800, equalize_branch=False):
+    """Build the ete3 nodes of the drawing and render them as render_tree does"""
+    tree, ts = drawing.build()
+    return render_tree(tree, ts, filename, w, h, equalize_branch)
+
+# Zoomable tile pyramid of a styled tree
+TILE_SIZE = 256
+
+# Minimal z/x/y viewer written next to the tiles
+TILE_VIEWER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>T-REX tree</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {{height: 100%; margin: 0; background: #FFFFFF}}</style></head>
+<body><div id="map"></div><script>
+var map = L.map("map", {{crs: L.CRS.Simple, minZoom: 0, maxZoom: {levels}}});
+var bounds = L.latLngBounds(map.unproject([0, {height}], {levels}), map.unproject([{width}, 0], {levels}));
+L.tileLayer("{{z}}/{{x}}/{{y}}.png", {{tileSize: {tile}, bounds: bounds, noWrap: true}}).addTo(map);
+map.fitBounds(bounds);
+</script></body></html>
+"""
+
+# Scene drawn by each tile worker, kept between tile batches
+_tile_scene: dict = {}
+
+def _init_tile_worker(drawing, equalize_branch):
+    """Build the ete3 nodes and scene once per worker process"""
+    tree, ts = drawing.build()
+    if equalize_branch:
+        for node in tree.traverse():
+            node.dist = 1.0
+    _tile_scene["scene"] = tree_scene(tree, ts)
+
+def _scene_rect():
+    """Position and size of the worker's scene"""
+    rect = _tile_scene["scene"].sceneRect()
+    return rect.x(), rect.y(), rect.width(), rect.height()
+
+def _render_tile_batch(batch):
+    """Draw (z, x, y) tiles from the worker's scene, one tile image in memory at a time"""
+    from ete3.treeview.qt import QImage, QColor, QPainter, QRectF, Qt
+    directory, levels, tiles, tile = batch
+    scene = _tile_scene["scene"]
+    left, top = scene.sceneRect().x(), scene.sceneRect().y()
+    for z, x, y in tiles:
+        span = tile * 2 ** (levels - z) # scene units covered by one tile at this level
+        image = QImage(tile, tile, QImage.Format_ARGB32)
+        image.fill(QColor(Qt.white).rgb())
+        painter = QPainter(image)
+        painter.setRenderHints(QPainter.Antialiasing | QPainter.TextAntialiasing | QPainter.SmoothPixmapTransform)
+        scene.render(painter, QRectF(0, 0, tile, tile), QRectF(left + x * span, top + y * span, span, span),
+                     Qt.IgnoreAspectRatio)
+        painter.end()
+        os.makedirs(os.path.join(directory, str(z), str(x)), exist_ok=True)
+        image.save(os.path.join(directory, str(z), str(x), f"{y}.png"), "PNG")
+    return len(tiles)
+
+def render_tiles(drawing, directory, workers=1, equalize_branch=False, progress=None, tile=TILE_SIZE, batch=64):
+    """Write a TreeDrawing as z/x/y PNG tiles with a viewer page, returning the deepest zoom level"""
+    # Level 0 fits the tree in one tile, the deepest level draws the scene at its natural size.
+    # Each worker builds the tree from the compact arrays and lays the scene out once, then draws batches of tiles
+    # from it, so neither ete3 nodes nor the full image are ever sent between processes.
+    if os.path.exists(os.path.join(directory, "tiles.json")): # tiles of an earlier tree, other files are kept
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.isdigit() and os.path.isdir(path): # zoom level folders
+                shutil.rmtree(path)
+            elif name in ("tiles.json", "index.html"):
+                os.remove(path)
+    os.makedirs(directory, exist_ok=True)
+    pool = multiprocessing.get_context("spawn").Pool(max(1, workers), initializer=_init_tile_worker,
+                                                      initargs=(drawing, equalize_branch))
+    try:
+        left, top, width, height = pool.apply(_scene_rect)
+        levels = max(0, math.ceil(math.log2(max(width, height) / tile)))
+        tiles = [(z, x, y) for z in range(levels + 1)
+                 for x in range(math.ceil(width / (tile * 2 ** (levels - z))))
+                 for y in range(math.ceil(height / (tile * 2 ** (levels - z))))]
+        batches = [(directory, levels, tiles[start:start + batch], tile) for start in range(0, len(tiles), batch)]
+        done = 0
+        for count in pool.imap_unordered(_render_tile_batch, batches):
+            done += count
+            if progress:
+                progress(f"{done} of {len(tiles)} tiles rendered...")
+        pool.close()
+    finally:
+        pool.terminate() # also stops workers when the job is cancelled
+    with open(os.path.join(directory, "tiles.json"), "w") as f:
+        json.dump({"width": width, "height": height, "tile": tile, "levels": levels}, f)
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write(TILE_VIEWER.format(width=width, height=height, tile=tile, levels=levels))
+    return levels
+
+# Raised inside a job after it has been cancelled
+class JobCancelled(Exception):
+    """The job was cancelled while it was running"""
+
+# Long tasks run away from the GUI thread
+class JobExecutor:
+    """Run jobs on a worker thread, or renders in a separate process, and hand progress and results back through poll"""
+    def __init__(self):
+        self.threads = ThreadPoolExecutor(max_workers=1) # jobs run one after another
+        self.pool = None # render process, started on first use
+        self.messages = queue.Queue()
+        self.running = [] # (name, done, result, cancel event or None for renders, on_done, on_error)
+
+    def busy(self):
+        """True while a submitted job has not been handed back by poll, including cancelled jobs still stopping"""
+        return bool(self.running)
+
+    def submit(self, name, fn, *args, on_done=None, on_error=None):
+        """Run fn(report, *args) on the worker thread, report(message) queues progress and stops cancelled jobs"""
+        cancel = threading.Event()
+        def report(message):
+            if cancel.is_set():
+                raise JobCancelled(name)
+            self.messages.put(message)
+        future = self.threads.submit(fn, report, *args)
+        self.running.append((name, future.done, future.result, cancel, on_done, on_error))
+
+    def submit_process(self, name, fn, *args, on_done=None, on_error=None):
+        """Run fn(*args) in a separate process, for work such as Qt rendering that cannot share the GUI process"""
+        if self.pool is None:
+            self.pool = multiprocessing.get_context("spawn").Pool(1) # a fresh interpreter, nothing of Tk or Qt is inherited
+        result = self.pool.apply_async(fn, args)
+        self.running.append((name, result.ready, result.get, None, on_done, on_error))
+
+    def poll(self, write):
+        """Pass queued progress to write and call back finished jobs, only call from the GUI thread"""
+        while True:
+            try:
+                write(self.messages.get_nowait())
+            except queue.Empty:
+                break
+        for job in [job for job in self.running if job[1]()]:
+            self.running.remove(job)
+            name, done, result, cancel, on_done, on_error = job
+            if cancel is not None and cancel.is_set():
+                continue # the results of cancelled jobs are dropped
+            try:
+                try:
+                    value = result()
+                except Exception as e:
+                    if not on_error:
+                        raise
+                    on_error(e)
+                else:
+                    if on_done:
+                        on_done(value)
+            except Exception as e: # a failing job or callback must not stop the others being handed back
+                write(f"{name} failed: {e}")
+
+    def cancel(self):
+        """Drop running jobs without their results, returning how many were cancelled"""
+        cancelled = 0
+        for job in list(self.running):
+            if job[3] is None:
+                if self.pool is not None:
+                    self.pool.terminate() # renders cannot be interrupted, so the process is stopped
+                    self.pool = None
+                self.running.remove(job)
+                cancelled += 1
+            elif not job[3].is_set():
+                job[3].set() # thread jobs stop at their next progress report and stay busy until they do
+                cancelled += 1
+        return cancelled
+
+    def shutdown(self):
+        """Cancel jobs and stop the worker thread and render process"""
+        self.cancel()
+        self.threads.shutdown(wait=False, cancel_futures=True)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
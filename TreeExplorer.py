@@ -3,23 +3,57 @@
 
 # Module Imports
 # System Functions
+import os
 import sys
-#Tree Exploration Imports
-from ete3 import Tree, TreeStyle, NodeStyle, AttrFace, TreeNode, RectFace, TextFace, ProfileFace
+import gc
+import argparse
+import subprocess
+from itertools import islice
 #Data processing
-import pandas as pd
 #import openpyxlcd
 #Interface Creation
 import tkinter as tk
 from tkinter import filedialog, simpledialog
 import tkinter.scrolledtext as tkst
-from tkinter import PhotoImage
 from tkinter.messagebox import askyesno
-from PIL import Image, ImageTk
 
 from tkinter import ttk
 
-import ctypes # Needed for dpi reset
+#Shared tree and table processing (also used by the command line renderer)
+#ete3, Qt, pandas and numpy are loaded by TreeCore when a feature first needs them, and PIL only to resize the logo
+from TreeCore import (PALETTES, BACKGROUND, JobExecutor, TableCache, read_table, cached_table, cached_heatmap, cache_heatmap,
+                      Genomap, query_columns, subset_labels, label_mapping, load_newick, relabel_leaves, TreeViews,
+                      generate_colors, missing_cells, scale_heatmap, compile_query, colour_query, collapse_branches,
+                      colour_strains, parse_ids, read_ids, StrainIndex, id_column, tree_style, style_nodes,
+                      apply_styles, heatmap_leaves, add_heatmap, add_heatmap_header, DETAIL_PIXELS,
+                      detail_clades, render_tiles, leaf_rows, TreeDrawing, render_drawing)
+
+# Logo shown in the main and tool windows
+LOGO = "./img/iff_logo.png"
+_logos: dict = {}
+
+# Resized logo, cached on disk and in memory
+def logo_image(width, height):
+    """Logo resized to width x height as a PhotoImage, PIL is only needed the first time a size is made"""
+    if (width, height) in _logos: # Reset and the tool window reuse the image
+        return _logos[width, height]
+    cached = os.path.join(TableCache().root, "logo", f"iff_logo_{width}x{height}.png")
+    try:
+        fresh = os.path.getmtime(cached) >= os.path.getmtime(LOGO)
+    except OSError:
+        fresh = False
+    if not fresh:
+        from PIL import Image, ImageTk
+        image = Image.open(LOGO).resize((width, height), Image.LANCZOS)
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            image.save(cached + ".tmp", "PNG")
+            os.replace(cached + ".tmp", cached)
+        except OSError: # the cache only saves time, the logo is shown without it
+            _logos[width, height] = ImageTk.PhotoImage(image)
+            return _logos[width, height]
+    _logos[width, height] = tk.PhotoImage(file=cached)
+    return _logos[width, height]
 
 class Application(tk.Frame, tk.Text):
     """ GUI application enabling the labelling and exploration of phylogenetic trees based on genogroup file information"""
@@ -29,7 +63,32 @@ class Application(tk.Frame, tk.Text):
         super(Application, self).__init__(master)
         self.grid()
         self.create_widgets()
+        self.init_session()
+
+        # Display settings are kept when the analysis is reset
+        self.collapseDepth: int = 2 # Node depth at which branches are collapsed
+        self.detailPixels: int = DETAIL_PIXELS # Clades drawn shorter than this are summarised, 0 draws every leaf
+
+        self.treetopology: dict = {"Rectangular topology selected": "r",
+                                   "Circular topology selected": "c"
+                                   } # set tree topology
+        
+        self.treetopologyValue: int = 0 # For toggling tree topology
+        self.tree_topology_output: str = "r"
+
+        self.tableCache = TableCache() # Parsed tables saved on disk for the next upload of the same file
+        self.jobs = JobExecutor() # File loads and renders run in the background
+        self.after(100, self.poll_jobs)
 
+        self.imageFormat: str = "png" # format of rendered tree files
+        self.toggle: int = 0 # for toggling below options
+        self.render_options: dict = {"render": False, "equalize_branch": False, "tiles": False}
+        # toggle write to file or show tree
+        # toggle branch lengths for image output aesthetics
+
+    # Analysis state, separate from the widgets so Reset can clear it without rebuilding the window
+    def init_session(self):
+        """Set the uploaded tables, tree, selections and their caches to an empty analysis"""
         self.subList: list = []  # Subsetting list for labels
         self.strainList: list = [] # Strain selection
         self.reference: dict = {} # Allows to retrieve strains from labels
@@ -45,33 +104,24 @@ class Application(tk.Frame, tk.Text):
         self.pruneList: list = [] # List selection for pruning 
         self.collapseList: list = [] # List selection for collapsing
 
-        self.treetopology: dict = {"Rectangular topology selected": "r",
-                                   "Circular topology selected": "c"
-                                   } # set tree topology
-        
-        self.treetopologyValue: int = 0 # For toggling tree topology
-        self.tree_topology_output: str = "r"
-
-        self.nodefaces: int = 0 # For tree modifications
         self.LTree = None # Processed tree
-        self.newick: str = "" # Raw tree file
-
-        self.heatmapfaces: int = 0 # For heatmap modifications
+        self.treeViews = None # Parsed tree and cached pruned views of it
+        self.viewState: dict = {} # ete3 nodes and faces of the processed tree once shown
+        self.leafIndex: dict = {} # Leaf name to node number lookup for processed tree
 
         self.value = None # For queries
 
         self.df: str = "" # Initial dataframe
-        self.new_df: str = "" # Processed dataframe
+        self.genomap = None # Genomap file, columns are read as they are selected
+        self.newdf: str = "" # Processed dataframe
+        self.labelCache: dict = {} # Label strings per column and per column selection
+        self.strainIndex = None # Search index over strain IDs
 
         self.hm: str = "" # Initial heatmap
-        self.new_hm: str = "" # Processed heatmap
+        self.new_hm: str = "" # Processed heatmap (scaled float32 matrix)
         self.hmcolumns: list = [] # columns
         self.hmrows: list = [] # rows
-
-        self.toggle: int = 0 # for toggling below options
-        self.render_options: dict = {"render": False, "equalize_branch": False}
-        # toggle write to file or show tree
-        # toggle branch lengths for image output aesthetics
+        self.hmcolours: dict = {} # Heatmap colours cached per colour scheme
 
     # Text output methods for writing concisely to text boxes
     def write(self, content):
@@ -85,17 +135,12 @@ class Application(tk.Frame, tk.Text):
 
         # create instruction label and logo
 
-        # Load the logo image and resize it
-        # Load the logo image and resize it
-        logo_image = Image.open("./img/iff_logo.png")
-        logo_image = logo_image.resize((300, 250), Image.LANCZOS)  # Adjust the desired size
-
-        # Convert the resized image to PhotoImage
-        logo_image = ImageTk.PhotoImage(logo_image)
+        # Load the resized logo image
+        logo = logo_image(300, 250)  # Adjust the desired size
 
         # Create a label to display the logo image
-        logo_label = tk.Label(self, image=logo_image)
-        logo_label.image = logo_image
+        logo_label = tk.Label(self, image=logo)
+        logo_label.image = logo
         logo_label.grid(row=0, column=0, columnspan=2, rowspan=2, pady=(15, 0))
 
         # Customize the label appearance
@@ -295,6 +340,8 @@ class Application(tk.Frame, tk.Text):
         # Configure the custom style for the hover effect
         Mstyle.configure("CustomMenuHover.TMenubutton", **menu_styleHover)
         Mstyle.map("CustomMenuHover.TMenubutton")
+        Mstyle.configure("CustomMenu.TButton", **menu_styles)
+        Mstyle.configure("CustomMenuHover.TButton", **menu_styleHover)
 
         def menu_on_enter(event, menu):
             menu.configure(style="CustomMenuHover.TMenubutton")
@@ -308,21 +355,20 @@ class Application(tk.Frame, tk.Text):
         
         #Style options for both menus
         
-        global options_1, options_2 #Make this globally available to enable update 
+        global options_1 #Make this globally available to enable update 
         global menu_1, menu_2 #Make this globally available to enable update
-        options_1, options_2 = ["LABEL OPTIONS"], ["SELECT STRAINS"]
-        global clicked_1, clicked_2 #Make this globally available to enable update 
-        clicked_1, clicked_2 = tk.StringVar(), tk.StringVar()
+        options_1 = ["LABEL OPTIONS"]
+        global clicked_1 #Make this globally available to enable update 
+        clicked_1 = tk.StringVar()
         clicked_1.set("LABEL OPTIONS") #Set name of button
-        clicked_2.set("SELECT STRAINS")
         menu_1 = ttk.OptionMenu(self, clicked_1, *options_1) #Genomap label menu
         menu_1.grid(row=14, column=0, sticky="we", padx=(5, 3), columnspan=2)
         menu_1.configure(style="CustomMenu.TMenubutton")
         bind_menu_events(menu_1)
-        menu_2 = ttk.OptionMenu(self, clicked_2, *options_2) #Strain subsetting menu
+        menu_2 = ttk.Button(self, text="SELECT STRAINS", command=self.strain_picker, style="CustomMenu.TButton") #Strain search window
         menu_2.grid(row=16, column=0, sticky="we", padx=(5, 3), columnspan=2)
-        menu_2.configure(style="CustomMenu.TMenubutton")
-        bind_menu_events(menu_2)
+        menu_2.bind("<Enter>", lambda event: menu_2.configure(style="CustomMenuHover.TButton"))
+        menu_2.bind("<Leave>", lambda event: menu_2.configure(style="CustomMenu.TButton"))
 
     # Bind the autoscroll() method to the <Button> event of all the buttons
     # Autoscroll bound to text boxes
@@ -380,6 +426,10 @@ class Application(tk.Frame, tk.Text):
         self.W1.insert(tk.END, "\n\nAll these queries can be combined for example: ")
         self.W1.insert(tk.END, "\nprtS=1 AND pH=(L,5) AND Lysotype=SoS-ST0234-SX AND DoublingTime=(20,25) AND colour=yellow")
         self.W1.insert(tk.END, "\nWill find prtS positive strains with pH less than 5, the lysotype of ST0234 and a doubling time between 20 and 25 minutes.")
+        self.W1.insert(tk.END, "\n\nSearches may also use OR, NOT and parentheses along with the comparisons =, !=, <, <=, > and >=.")
+        self.W1.insert(tk.END, "\nThe colour can be given after an arrow and several searches, each with its own colour, can be entered at once")
+        self.W1.insert(tk.END, "\nseparated by ';'. Where a strain matches more than one search the first one applies, for example:")
+        self.W1.insert(tk.END, "\nprtS=1 AND (pH<5 OR NOT Lysotype=A) -> red; DoublingTime>=25 -> blue")
         self.W1.insert(tk.END, "\n\nThis functionality is quite sensitive so whilst you will be informed of some mistakes")
         self.W1.insert(tk.END, "\nit is possible that in some cases the absence of highlighting is due to an unusual error. So be careful.")
 
@@ -399,7 +449,7 @@ class Application(tk.Frame, tk.Text):
         self.W1.insert(tk.END, "\nAfter upload click to apply the heatmap and select the desired formatting options (e.g. grayscale or remove column names etc)")
 
         self.W1.insert(tk.END, "\n\nExplanations for Each Button", "bold")
-        self.W1.insert(tk.END, "\n\nUpload Genomap: To upload your table containing strain names and characteristics of interest.")
+        self.W1.insert(tk.END, "\n\nUpload Genomap: To upload your table containing strain names and characteristics of interest. Csv files may be compressed (.csv.gz, or .csv.zst with the zstandard package installed) and only the columns you select are read.")
         self.W1.insert(tk.END, "\nUpload Tree File: To upload your phylogenetic tree in newick format.")
         self.W1.insert(tk.END, "\nShow Tree: Display tree.")
         self.W1.insert(tk.END, "\nReset: Remove all files and formatting to start a new analysis.")
@@ -412,7 +462,7 @@ class Application(tk.Frame, tk.Text):
         self.W1.insert(tk.END, "\nClear Colour: Remove all colour formatting.")
         self.W1.insert(tk.END, "\nAbout: Opens this box.")
         self.W1.insert(tk.END, "\nLabel Options: Contains characteristics derived from genomap file.")
-        self.W1.insert(tk.END, "\nSelect Strains: Select strains for further analysis.")
+        self.W1.insert(tk.END, "\nSelect Strains: Search strain IDs as you type and add matches, or import an ID list file, for further analysis.")
         self.W1.insert(tk.END, "\nUpload HM: Upload you heatmap file if desired.")
         self.W1.insert(tk.END, "\nActivate HM: apply formatting and show heatmap.")
         self.W1.insert(tk.END, "\nOther Tools: Display menu containing other tools.")
@@ -424,6 +474,12 @@ class Application(tk.Frame, tk.Text):
         self.W1.insert(tk.END, "\nTree Name Exchange: Upload a file with old and new times to swap those in the tree.")
         self.W1.insert(tk.END, "\nChange Tree Topology: Toggle rectangular and circular forms of tree.")
         self.W1.insert(tk.END, "\nExport Tree File: Export raw tree file for other uses (labels also exported)")
+        self.W1.insert(tk.END, "\nShow/Render Tree: Toggle showing the tree, writing it to file, with equal branch lengths, or as zoomable tiles for huge trees")
+        self.W1.insert(tk.END, "\nImage Format: Write rendered trees as PNG, or as SVG or PDF vector images for publication and large heatmaps")
+        self.W1.insert(tk.END, "\nCollapse Depth: Choose how far from the root branches are collapsed (default 2)")
+        self.W1.insert(tk.END, "\nLevel of Detail: In trees rendered to file, clades too small to see are drawn as triangles with their leaf count and most common label (default 10 pixels, 0 draws every leaf). Shown trees always draw every leaf")
+        self.W1.insert(tk.END, "\nImport Strain List: Select many strains at once by pasting IDs or loading an ID list file")
+        self.W1.insert(tk.END, "\nCancel Running Tasks: Stop file uploads or tree rendering still in progress")
         self.W1.insert(tk.END, "\nClose Window: Closes this tool box")
         
 
@@ -437,39 +493,85 @@ class Application(tk.Frame, tk.Text):
     # Closes program 
     def Close(self):
         """Closes the Program"""
+        self.jobs.shutdown()
         root.destroy()
         sys.exit()
 
+    # Run a long task without freezing the window
+    def run_job(self, name, fn, *args, on_done=None, on_error=None, process=False):
+        """Submit a job to the executor unless another one is still running"""
+        if not self.idle():
+            return False
+        text_box.insert(tk.END, f'\n\n{name} started...')
+        if process:
+            self.jobs.submit_process(name, fn, *args, on_done=on_done, on_error=on_error)
+        else:
+            self.jobs.submit(name, fn, *args, on_done=on_done, on_error=on_error)
+        return True
+
+    # Check that no job is using the loaded data
+    def idle(self):
+        """True when no job is running, otherwise ask the user to wait"""
+        if self.jobs.busy():
+            text_box.insert(tk.END, "\n\nPlease wait for the running task to finish or cancel it from Other Tools.")
+            return False
+        return True
+
+    # Hand job progress and results back to the window
+    def poll_jobs(self):
+        """Show progress and finish completed jobs, repeated while the window is open"""
+        try:
+            self.jobs.poll(self.job_message)
+        finally:
+            self.after(100, self.poll_jobs)
+
+    def job_message(self, message):
+        """Progress message from a running job"""
+        text_box.insert(tk.END, f'\n{message}')
+        text_box.see(tk.END)
+
+    # Stop running jobs
+    def cancel_jobs(self):
+        """Cancel file loads or renders in progress"""
+        cancelled = self.jobs.cancel()
+        if cancelled:
+            text_box.insert(tk.END, f"\n\n{cancelled} running task(s) cancelled.")
+        elif self.jobs.busy():
+            text_box.insert(tk.END, "\n\nCancelled tasks are still stopping, please wait for them to finish.")
+        else:
+            text_box.insert(tk.END, "\n\nNo tasks are running.")
+
     # Upload and processing of genogroup file - menus also updated
     def UploadGenogroup(self):
         """Genogroup File Upload"""
+        if not self.idle():
+            return None
         text_box.delete(1.0,tk.END)
         filename = filedialog.askopenfilename()
         if filename:
             if "csv" or "xls" in filename:
                 text_box.insert(tk.END, '\n\nSelected: ' + str(filename))
-                #Data processing
-                if "csv" in filename:
-                    self.df = pd.read_csv(filename, encoding="ISO-8859-1")
-                else:
-                    self.df = pd.read_excel(filename)
-                #Remove characters that may cause problems
-                self.df = self.df.apply(lambda x: x.replace('(','').replace(')',''))
-                #Modify Data to include header
-                colnames = self.df.columns.values.tolist() #Extract column names
-                colnames.pop(0) #Do not include genome name as this is needed to reference tree
-
-                self.UpdateMenuGeno(menu_1, clicked_1, self.df)
-                self.UpdateMenuStrain(menu_2, clicked_2, self.df)
+                #Data processing in the background, identifiers only until columns are selected
+                def job(report):
+                    return Genomap(filename, lambda rows: report(f'{rows} rows read...'), self.tableCache)
+                self.run_job("Genomap upload", job, on_done=self.genomap_loaded, on_error=lambda e: self.call_error(8))
             else:
                 self.call_error(8) # File invalid error
-
-            #Modification of DF values to provide meaningful labels for the tree (e.g. Prts-1 instead of simply 1)
-            for i in colnames:
-                self.df[i] = str(i).replace('(','').replace(')','') + "_" + self.df[i].astype(str).replace("nan", "NONE") 
-            text_box.insert(tk.END, '\n\nPlease apply subsetting before tree upload if desired.')
         else:
             text_box.insert(tk.END, "Please upload a genomap and/or tree file to get started.")
+
+    # Keep the uploaded genomap and offer its columns as labels
+    def genomap_loaded(self, genomap):
+        """Finish genomap upload once identifiers have been read"""
+        self.genomap, self.df = genomap, genomap.df
+        self.labelCache = {} # Labels belong to previous genomap
+        self.strainIndex = None # Strain search is rebuilt from the new genomap
+        text_box.insert(tk.END, f'\n{len(self.df)} strains and {len(self.genomap.columns) - 1} label columns found.')
+
+        self.UpdateMenuGeno(menu_1, clicked_1, self.genomap.columns)
+
+        # Values stay typed for queries, label strings are built for selected columns in subset
+        text_box.insert(tk.END, '\n\nPlease apply subsetting before tree upload if desired.')
     
     # Upload of tree file
     def UploadTree(self):
@@ -481,47 +583,74 @@ class Application(tk.Frame, tk.Text):
                 return False
             return True
 
+        if not self.idle():
+            return None
         if not isinstance(self.df, str):
             if not self.subList:
                 answer = askyesno(title='Genotype Subsetting',
                 message='Are you happy to build a tree with no labels?')
                 if answer:
-                    self.subset(self.df, self.subList)
                     text_box.delete(1.0,tk.END)
                     filename = filedialog.askopenfilename()
                     if not newick_QC(str(filename)):
                         self.call_error(5)
-                    try:
-                        text_box.insert(tk.END, '\n\nSelected: ' + str(filename))
-                        with open(filename, "r") as f:
-                                self.newick = f.read()
-                        return self.newickModify(self.newick, self.newdf)
-                    except IOError:
-                        self.call_error(5)
+                    self.load_tree(filename)
                 else:
                     text_box.insert(tk.END, '\n\nPlease subset genogroups before uploading tree file')
             else:
-                self.subset(self.df, self.subList)
                 text_box.delete(1.0,tk.END)
                 filename = filedialog.askopenfilename()
-                text_box.insert(tk.END, '\n\nSelected: ' + str(filename))
-                with open(filename, "r") as f:
-                    self.newick = f.read()
-                return self.newickModify(self.newick, self.newdf)
+                self.load_tree(filename)
         else:
             answer = askyesno(title='Only Tree Upload',
                 message='You are uploading a tree without genomap file. Do you wish to proceed?')
             if answer:
                 text_box.delete(1.0,tk.END)
                 filename = filedialog.askopenfilename()
-                text_box.insert(tk.END, '\n\nSelected: ' + str(filename))
-                with open(filename, "r") as f:
-                    self.newick = f.read()
-                self.LTree = Tree(self.newick)
-                return self.LTree
+                self.load_tree(filename, labelled=False)
             else:
                 text_box.insert(tk.END, '\n\nPlease Upload Genomap and/or tree files.')
 
+    # Read, label and parse a newick file in the background
+    def load_tree(self, filename, labelled=True):
+        """Tree upload job, labels are built from the selected genomap columns"""
+        text_box.insert(tk.END, '\n\nSelected: ' + str(filename))
+        genomap, subList, cache = self.genomap if labelled else None, list(self.subList), self.labelCache
+        def job(report):
+            report("Reading tree...")
+            tree = load_newick(filename, self.tableCache) # parsed once, then read from its binary copy
+            newdf, mapping = None, {}
+            if genomap is not None:
+                df = genomap.require(subList, lambda rows: report(f'{rows} rows read...'))
+                newdf = subset_labels(df, subList, cache)
+                mapping = label_mapping(newdf) # extract first column if genome ID not present
+                relabel_leaves(tree, mapping) # exact leaf matches only
+            return newdf, mapping, TreeViews(tree)
+        self.run_job("Tree upload", job, on_done=self.newickModify, on_error=self.tree_error)
+
+    # Keep the labelled tree & label lookup once parsing has finished
+    def newickModify(self, result):
+        """Finish tree upload with the parsed tree and genomap labels"""
+        newdf, mapping, self.treeViews = result
+        if newdf is not None:
+            if "GenomeID" not in newdf.columns:
+                text_box.insert(tk.END, "\n\nGenomeID column not detected. Extraction used the first column.")
+            self.df, self.newdf = self.genomap.df, newdf
+            self.reference.update(mapping)
+        else:
+            self.strainIndex = None # strains are searched by tree name
+        self.select_view()
+        text_box.insert(tk.END, f'\n\nTree loaded with {len(self.leafIndex)} leaves.')
+        return self.LTree
+
+    # Report tree upload problems
+    def tree_error(self, error):
+        """Genome ID problems while labelling, otherwise file problems"""
+        if isinstance(error, (KeyError, IndexError)):
+            self.call_error(11) # call error for genome ID problems
+        else:
+            self.call_error(5)
+
     # Heatmap formatting options
     def heatmap_options(self):
         """Provides options for heatmap formatting"""
@@ -622,18 +751,14 @@ class Application(tk.Frame, tk.Text):
 
         # new window
         toolwindow = tk.Toplevel(self, bg="lightgrey")
-        toolwindow.geometry("290x550")
+        toolwindow.geometry("290x785")
 
-        # Load the logo image and resize it
-        logo_image = Image.open("./img/iff_logo.png")
-        logo_image = logo_image.resize((250, 200), Image.LANCZOS)  # Adjust the desired size
-
-        # Convert the resized image to PhotoImage
-        logo_image = ImageTk.PhotoImage(logo_image)
+        # Load the resized logo image
+        logo = logo_image(250, 200)  # Adjust the desired size
 
         # Create a label to display the logo image
-        logo_label = tk.Label(toolwindow, image=logo_image)
-        logo_label.image = logo_image
+        logo_label = tk.Label(toolwindow, image=logo)
+        logo_label.image = logo
         logo_label.grid(row=0, column=0, columnspan=2, rowspan=2, pady=(15, 0))
 
         # Customize the label appearance
@@ -696,9 +821,11 @@ class Application(tk.Frame, tk.Text):
         self.extra_buttons = []
 
         button_names = ["EXPORT LABELLED DATA", "TREE NAME EXPORT", "TREE NAME EXCHANGE", "CHANGE TREE TOPOLOGY",
-                        "EXPORT TREE FILE" , "SHOW/RENDER TREE", "CLOSE WINDOW"]
+                        "EXPORT TREE FILE" , "SHOW/RENDER TREE", "IMAGE FORMAT", "COLLAPSE DEPTH", "LEVEL OF DETAIL",
+                        "IMPORT STRAIN LIST", "CANCEL RUNNING TASKS", "CLOSE WINDOW"]
         button_commands = [self.export_labelled, self.export_treenames, self.tree_exchange, self.tree_topology,
-                           self.export_tree, self.render_tree, close]
+                           self.export_tree, self.render_tree, self.image_format, self.collapse_depth, self.level_of_detail,
+                           self.import_strains, self.cancel_jobs, close]
 
         for i, text in enumerate(button_names):
             if text != "CLOSE WINDOW":
@@ -715,6 +842,8 @@ class Application(tk.Frame, tk.Text):
     # Upload of heatmap if desired
     def UploadHeatmap(self):
         """Upload heatmap file for display on tree"""
+        if not self.idle():
+            return None
         text_box.delete(1.0,tk.END)
         #MAKE WARNING APPEAR - No labels on tree
         answer = askyesno(title='Heatmap Construction',
@@ -724,105 +853,92 @@ class Application(tk.Frame, tk.Text):
             if heatmap:
                 if "csv" or "xls" in heatmap:
                     text_box.insert(tk.END, '\n\nSelected: ' + str(heatmap))
-                    #Data processing
-                    if "csv" in heatmap:
-                        self.hm = pd.read_csv(heatmap, encoding="ISO-8859-1")
-                    else:
-                        self.hm = pd.read_excel(heatmap)
-
-                self.new_hm = self.minmaxdf(self.hm) # Process dataframe to heatmap
-                # Convert heatmap to dictionary
-                text_box.insert(tk.END, "\n\nHeatmap successfully processed!")
+                    #Data processing in the background, scaled heatmaps are reused from the cache
+                    def job(report):
+                        entry = self.tableCache.entry(heatmap, "heatmap")
+                        cached = cached_heatmap(entry)
+                        if cached is not None:
+                            report("Scaled heatmap found in cache.")
+                            return entry, None, cached
+                        return entry, read_table(heatmap), None
+                    self.run_job("Heatmap upload", job, on_done=self.heatmap_loaded, on_error=lambda e: self.call_error(8))
             else:
                 self.call_error(8) # File invalid error
         else:
             text_box.insert(tk.END, "\n\nPlease upload heatmap on a label free map to continue.")
 
+    # Process the heatmap once it has been read
+    def heatmap_loaded(self, result):
+        """Finish heatmap upload with scaling and checks"""
+        entry, self.hm, cached = result
+        if cached is not None:
+            self.hmrows, self.hmcolumns, self.new_hm = cached
+        else:
+            try:
+                self.new_hm = self.minmaxdf(self.hm) # Process dataframe to heatmap
+            except ValueError:
+                return None # problems already reported by minmaxdf
+            cache_heatmap(entry, self.hmrows, self.hmcolumns, self.new_hm)
+        self.hmcolours = {} # Colours belong to previous heatmap
+        text_box.insert(tk.END, "\n\nHeatmap successfully processed!")
+
     # Normalize dataframe and deal with other data types plus process
     def minmaxdf(self, df):
         """Normalize values in df and perform other processing"""
 
-        # Need some internal functions
-
-        # Displays output when exception raised
-
-        # Check for missing values
-        def is_NaN(val):
-            """Check if value is NAN"""
-            return val != val
-
-        # Iteration over DF for quality checking
-        def col_iter(df):
-            """Allows iteration over whole dataframe"""
-            cols = df.columns.values.tolist()
-            for _, i in df.iterrows():
-                for j in cols:
-                    if is_NaN(i[j]):    # Apply is_NaN and raise error if true - message displayed
-                        raise ValueError(self.call_error(1)) # Error function called
-                    
         # First column is index
         df = df.set_index(df.columns[0])
-        col_iter(df) # Blank value check
-        
-        # OTHER VALUES TO REPLACE
 
-        value_replacement = {"+": 1, "-": 0, "Y": 1, "N": 0} # Values replaced in df for presence/absence
-        for k in value_replacement:
-            if df.isin([k]).any().any():
-                df.replace(k, value_replacement[k], inplace=True) 
-        
-        # Min/Max scaling with handling for edge cases
-        df_min = df.min()
-        df_max = df.max()
-        df_range = df_max - df_min # Value difference
-        df_range_nonzero = df_range.replace(0, 1)  # Replace zero range with 1 to avoid zero div errors
-        df_scaled = (df - df_min) / df_range_nonzero
-        
-        # Handle case when all values are 1 to avoid NaN being generated
-        if (df_scaled == 1).all().all():
-            df_scaled = df_scaled.replace(1, 0)
-        
-        self.hmcolumns = df_scaled.columns.values.tolist()
-        
-        heatmap_data = []
-        for index, row in df_scaled.iterrows():
-            values = row.tolist()
-            name = index
-            data = {"name": name, "values": values}
-            heatmap_data.append(data)
+        # Blank value check - report the exact cells so they can be fixed
+        cells = missing_cells(df)
+        if cells:
+            self.call_error(1)
+            shown = "\n".join(f"Row {row}, column {col}" for row, col in cells[:20])
+            if len(cells) > 20:
+                shown += f"\n... and {len(cells) - 20} more"
+            text_box.insert(tk.END, f"\n\nMissing values in {len(cells)} cells:\n{shown}")
+            raise ValueError(f"{len(cells)} missing values in heatmap")
 
+        try:
+            heatmap_data = scale_heatmap(df)
+        except ValueError as e:
+            self.call_error(1)
+            text_box.insert(tk.END, f"\n\n{e}")
+            raise
+
+        # Rows are looked up by position in the scaled matrix
+        self.hmrows = df.index.tolist()
+        self.hmcolumns = df.columns.values.tolist()
         return heatmap_data
 
     # Performs update of genogroup menu providing select options and click traces
-    def UpdateMenuGeno(self, menu, var, df):
+    def UpdateMenuGeno(self, menu, var, columns):
         """Update Menu Options Based on Uploads"""
         menu.configure(state='normal') # Enable drop down
         menu = menu['menu']
         menu.delete(0, 'end')
-        for col in df.columns.values.tolist()[1:]:
+        for col in columns[1:]:
             # Add menu items
             menu.add_command(label=col, command=lambda col=col: var.set(col))
-        var.trace("w", self.GenogroupSelector)
-        return menu
-        
-    # Performs update of strain menu providing select options and click traces
-    def UpdateMenuStrain(self, menu, var, df):
-        """Update Strain Menu Options Based on Uploads"""
-        menu.configure(state='normal') # Enable drop down
-        menu = menu['menu']
-        menu.delete(0, 'end')
-        for i, r in df.iterrows():
-            # Add menu items
-            try:
-                if "GenomeID" in df.columns:
-                    x = r["GenomeID"]
-                else:
-                    x = r.iloc[0]
-            except IOError:
-                self.call_error(11) # call error on genome ID
-        var.trace("w", self.StrainSelector)
+        self.clear_traces(var) # one selector however many genomaps are uploaded
+        var.trace_add("write", self.GenogroupSelector)
         return menu
 
+    # Remove selection callbacks from a menu variable
+    def clear_traces(self, var):
+        """Delete every trace on a tkinter variable along with its Tcl command"""
+        for mode, callback in var.trace_info():
+            var.trace_remove(mode, callback)
+
+    # Return the label menu to how it was before any upload
+    def clear_menus(self):
+        """Empty the genomap label menu without rebuilding it"""
+        self.clear_traces(clicked_1) # resetting the title is not a label selection
+        clicked_1.set("LABEL OPTIONS")
+        menu = menu_1['menu']
+        menu.delete(0, 'end')
+        menu.add_command(label="LABEL OPTIONS", command=lambda: clicked_1.set("LABEL OPTIONS"))
+        
     # Updates list with genogroup selections for later subsetting
     def GenogroupSelector(self, *args):
         """Retrieve items selected from genogroup menu"""
@@ -834,55 +950,195 @@ class Application(tk.Frame, tk.Text):
         else:
             text_box.insert(tk.END, '\n' + temp + ' already selected!') 
 
-    # Updates list with strain selections for ltree collapse
-    def StrainSelector(self, *args):
-        """Retrieve strains selected from strains menu"""
-        temp = str(clicked_2.get())
-        if temp not in self.strainList:
-            self.strainList.append(temp)
-            text_box.delete(1.0,tk.END)
-            text_box.insert(tk.END, '\nSelected: ' + ", ".join(self.strainList))
-        else:
-            text_box.insert(tk.END, '\n' + temp + ' already selected!') 
-
-    # Subset genogroups method
-    def subset(self, df, subList): #ADJUST WITH SELECTED VALUES
-        """Function applying subset values to return new DF"""
-        #add function to read in sublist
-        id = df.columns.values.tolist()[0]
-        subList.insert(0, id)
-        self.newdf = df.filter(subList, axis=1)
-        #create new row which will be tree label
-        self.newdf['Label'] = self.newdf[[col for col in self.newdf.columns]].agg(' // '.join, axis=1)
-        return self.newdf
-
-    # Modify Newick tree labels according to genogroup selections & return tree object
-    def newickModify(self, tree, newdf):
-        IDList, Labels = [],[]
-        if "GenomeID" not in newdf.columns:
-            text_box.insert(tk.END, "\n\nGenomeID column not detected. Attempting extraction nonetheless...")
-        for i, j in newdf.iterrows():
-            try:
-                if "GenomeID" in newdf.columns:
-                    IDList.append(j["GenomeID"]) # extract genome ID
-                else:
-                    IDList.append(j.iloc[0]) # extract first column if genome ID not present
-            except IOError:
-                self.call_error(11) # call error for genome ID problems
-            Labels.append(j["Label"])
-        for idx, item in enumerate(IDList):
-            self.reference.update({str(item):str(Labels[idx])})
-            tree = tree.replace(str(item), str(Labels[idx]))
-        self.LTree = Tree(tree)
+    # Strain search index from genomap IDs, or tree names when no genomap is loaded
+    def strain_index(self):
+        """Build the strain search index on first use"""
+        if self.strainIndex is None:
+            if not isinstance(self.df, str):
+                self.strainIndex = StrainIndex(self.df[id_column(self.df)].astype(str))
+            elif self.leafIndex:
+                self.strainIndex = StrainIndex(self.leafIndex)
+        return self.strainIndex
+
+    # Searchable strain selection window
+    def strain_picker(self):
+        """Type-ahead strain search, listing results a page at a time as the list is scrolled"""
+        index = self.strain_index()
+        if index is None:
+            text_box.insert(tk.END, "\nPlease upload a genomap or tree file before selecting strains.")
+            return None
+        picker = tk.Toplevel(root)
+        picker.geometry("360x520")
+        label = tk.Label(picker, text=f"Search {len(index)} strain IDs. Double click or add selected strains:")
+        label.pack()
+        query = tk.StringVar()
+        entry = tk.Entry(picker, textvariable=query, width=45)
+        entry.pack()
+        entry.focus_set()
+        frame = tk.Frame(picker)
+        frame.pack(fill="both", expand=True)
+        scrollbar = tk.Scrollbar(frame)
+        scrollbar.pack(side="right", fill="y")
+        results = tk.Listbox(frame, selectmode=tk.EXTENDED, width=45)
+        results.pack(side="left", fill="both", expand=True)
+        status = tk.Label(picker, text="")
+        status.pack()
+        search = {"matches": iter(()), "more": False, "pending": None}
+
+        def load_page():
+            """Add the next page of matches, only rows near the view are ever created"""
+            page = list(islice(search["matches"], 200))
+            if page:
+                results.insert(tk.END, *page)
+            search["more"] = len(page) == 200
+            status.config(text=f"{results.size()} matches shown" + (", scroll for more" if search["more"] else ""))
+
+        def on_scroll(first, last):
+            scrollbar.set(first, last)
+            if search["more"] and float(last) > 0.9:
+                load_page()
+
+        def refresh():
+            search["pending"] = None
+            results.delete(0, tk.END)
+            search["matches"] = index.search(query.get())
+            load_page()
+
+        def on_type(*args):
+            if search["pending"]: # wait for a pause in typing before searching
+                picker.after_cancel(search["pending"])
+            search["pending"] = picker.after(150, refresh)
+
+        def add_selected(*args):
+            self.add_strains([results.get(i) for i in results.curselection()])
+
+        def add_all():
+            self.add_strains(list(results.get(0, tk.END)) + list(search["matches"]))
+            refresh()
+
+        def import_file():
+            filename = filedialog.askopenfilename()
+            if filename:
+                try:
+                    self.add_strains(read_ids(filename))
+                except (IOError, ValueError):
+                    self.call_error(13)
+
+        results.config(yscrollcommand=on_scroll)
+        scrollbar.config(command=results.yview)
+        results.bind("<Double-Button-1>", add_selected)
+        query.trace_add("write", on_type)
+        for text, command in [("Add Selected", add_selected), ("Add All Matches", add_all),
+                              ("Import ID List File", import_file), ("Close", picker.destroy)]:
+            button = tk.Button(picker, text=text, command=command)
+            button.pack(fill="x")
+        refresh()
+        return picker
+
+    # Add many strains to the selection at once
+    def add_strains(self, ids):
+        """Extend the strain selection with new IDs and report any missing from the tree"""
+        selected = set(self.strainList)
+        new = [i for i in ids if i not in selected]
+        self.strainList.extend(new)
+        text_box.delete(1.0,tk.END)
+        text_box.insert(tk.END, f'\n{len(new)} strains added, {len(self.strainList)} selected in total.')
+        if self.leafIndex:
+            missing = [i for i in new if self.reference.get(i, i) not in self.leafIndex]
+            if missing:
+                text_box.insert(tk.END, f'\n{len(missing)} not found in the tree: ' + ", ".join(missing[:20]))
+        return self.strainList
+
+    # Dialog to paste or upload a strain list
+    def import_strains(self):
+        """Bulk strain selection from pasted IDs or an ID list file"""
+        dialog = tk.Toplevel(root)
+        dialog.geometry("400x420")
+        label = tk.Label(dialog, text="Paste strain IDs (one per line or separated by commas), or load a file:")
+        label.pack()
+        entry = tk.Text(dialog, width=45, height=20)
+        entry.pack()
+
+        def load_file():
+            filename = filedialog.askopenfilename()
+            if filename:
+                try:
+                    self.add_strains(read_ids(filename))
+                except (IOError, ValueError):
+                    self.call_error(13)
+                dialog.destroy()
+
+        def submit():
+            self.add_strains(parse_ids(entry.get(1.0, tk.END)))
+            dialog.destroy()
+
+        load_button = tk.Button(dialog, text="Load File", command=load_file)
+        load_button.pack()
+        submit_button = tk.Button(dialog, text="Add Strains", command=submit)
+        submit_button.pack()
+        return dialog
+
+    # Switch to the tree view matching the prune options
+    def select_view(self):
+        """Point the processed tree at the whole tree or a cached pruned copy"""
+        leaves = self.treeViews.base.leaf_index # strains chosen before this tree was uploaded may not be in it
+        prune = [name for name in self.pruneList if name in leaves] if self.pruneStatus else ()
+        self.LTree, self.viewState = self.treeViews.get(prune)
+        self.leafIndex = self.LTree.leaf_index
         return self.LTree
 
+    # ete3 nodes are only needed for the interactive view
+    def display_nodes(self, heatmap=None):
+        """ete3 nodes of the processed tree in preorder with every leaf, built the first time the view is shown"""
+        if "nodes" not in self.viewState:
+            nodes = self.LTree.to_nodes()
+            style_nodes(nodes[0]) # node shapes and tip names are kept on the nodes between views
+            self.viewState.update(nodes=nodes, applied={})
+        if heatmap is not None and "heatmapFaces" not in self.viewState:
+            add_heatmap(self.viewState["nodes"], *heatmap)
+            self.viewState["heatmapFaces"] = True # stop duplicate heatmaps when reimaging tree
+        return self.viewState["nodes"]
+
+    # Level of detail of rendered images
+    def render_summaries(self):
+        """Clades drawn as summaries when rendering to file, kept with the view until the level of detail changes"""
+        detail = 0 if self.render_options["tiles"] else self.detailPixels # tiles are zoomed so every leaf is drawn
+        if self.viewState.get("detail", (None,))[0] != detail:
+            # clades too small to see at the 800 pixel image height are drawn as one summary each
+            summaries = detail_clades(self.LTree, 800 // detail) if detail else []
+            self.viewState["detail"] = (detail, summaries)
+            if len(summaries):
+                text_box.insert(tk.END, f"\n\n{len(summaries)} clades are too small to draw and are shown as summaries.")
+        return self.viewState["detail"][1]
+
+    # Genomap rows of the tree leaves for label searches
+    def genomap_rows(self):
+        """Leaves and genomap row positions of the processed tree, kept with the view until the genomap changes"""
+        rows = self.viewState.get("rows")
+        if rows is None or rows[0] is not self.df:
+            rows = self.viewState["rows"] = (self.df, leaf_rows(self.leafIndex, self.reference, self.df))
+        return rows[1]
+
+    # Tree names of selected strains
+    def tree_names(self, strains):
+        """Leaf names of the strains, skipping and reporting those not in the tree once one is loaded"""
+        names = [self.reference.get(item, item) for item in strains]
+        if not self.treeViews:
+            return names
+        leaves = self.treeViews.base.leaf_index # whole tree, so strains outside the current prune can be added
+        missing = [item for item, name in zip(strains, names) if name not in leaves]
+        if missing:
+            text_box.insert(tk.END, f'\n{len(missing)} selected strains are not in the tree and were skipped: '
+                                    + ", ".join(missing[:20]))
+        return [name for name in names if name in leaves]
+
     # Prune tree based on selected strains
     def treePrune(self):
         """Generate a sublist used for pruning the tree later"""
         if self.strainList:
-            for item in self.strainList:
-                self.pruneList.append(self.reference[item]) #using strain values get labels created
-                self.pruneStatus = True
+            names = self.tree_names(self.strainList) #using strain values get labels created
+            self.pruneList.extend(names)
+            self.pruneStatus = self.pruneStatus or bool(names)
         else:
             text_box.insert(tk.END, "\nCannot prune tree as no strains have been selected!")
         return self.pruneList
@@ -893,12 +1149,10 @@ class Application(tk.Frame, tk.Text):
         try:
             self.pruneList, self.collapseList, self.strainList = [],[],[]
             self.pruneStatus, self.collapseStatus = False, False
-            self.nodefaces = 0
- 
-            for leaf in self.LTree.get_leaves():
-                self.LTree.img_style["draw_descendants"] = True
 
-            self.newickModify(self.newick, self.newdf)
+            for tree, state in self.treeViews.views(): # pruned views stay cached for reuse
+                tree.collapsed[:] = False
+            self.select_view()
 
             text_box.insert(tk.END, "\n\nPruning and/or collapse options have been cleared!")
             text_box.insert(tk.END, "\nYou may now display the entire tree or apply new parameters")
@@ -910,7 +1164,7 @@ class Application(tk.Frame, tk.Text):
         """Custom dialog box for queries"""
         self.dialog = tk.Toplevel(root)
         self.dialog.geometry("500x250")
-        label = tk.Label(self.dialog, text="Enter your search query:")
+        label = tk.Label(self.dialog, text="Enter your search query (separate several 'search -> colour' rules with ';'):")
         label.pack()
         self.entry = tk.Entry(self.dialog, width=75)
         self.entry.pack()
@@ -929,11 +1183,9 @@ class Application(tk.Frame, tk.Text):
     def qualitycheck(self, input):
         """Performs series of quality checks on query inputs"""
         COMMONCOLOURS = ["RED", "YELLOW", "GREEN", "BLUE", "BLACK", "ORANGE", "PINK", "BROWN", "GRAY", "#"]
-        if "AND" not in input.upper():
-            self.call_error(2)
-        if not any(i for i in COMMONCOLOURS if i in input.upper()):
+        if "->" not in input and not any(i for i in COMMONCOLOURS if i in input.upper()):
             self.call_error(3)
-        if "=" not in input.upper():
+        if not any(i in input for i in ("=", "<", ">", "_")):
             self.call_error(4)
 
     # Process query values
@@ -942,94 +1194,49 @@ class Application(tk.Frame, tk.Text):
         if self.value:
             #Perform some quality checks
             self.qualitycheck(self.value)
-            #Process input
-            self.value = self.value.replace("=", "_").replace("and", "AND") # to also accept = nomenclature
-            self.value = self.value.split(sep=" AND ")
-            if len(self.value) == 1:
-                self.value.append("#FEE715")
-            self.colourStatus = True
+            if isinstance(self.df, str):
+                text_box.insert(tk.END, "\nPlease upload a genomap file to search labels.")
+                return None
+            if not self.idle(): # a running upload may be reading genomap columns
+                return None
+            #Process input once into predicates on the genomap columns
+            try:
+                self.value = compile_query(self.value, self.genomap.columns[1:])
+            except ValueError as e:
+                self.call_error(12)
+                text_box.insert(tk.END, f"\n{e}")
+                self.value = None
+                return None
+            # Searched columns not loaded yet are read in the background
+            genomap, columns = self.genomap, query_columns(self.value)
+            def job(report):
+                return genomap.require(columns, lambda rows: report(f'{rows} rows read...'))
+            self.run_job("Label search", job, on_done=self.query_ready)
             return self.value
         else:
             text_box.insert(tk.END, "\nPlease enter label names and colour if you wish to add colour coding to the tree.")
 
+    # Apply a search once its columns have been read
+    def query_ready(self, df):
+        """Finish a label search with the genomap columns it needs"""
+        self.df = df
+        self.colourStatus = True
+        text_box.insert(tk.END, "\nSearch ready, click 'Show Tree' to colour matching strains.")
+
     # Tied to button to open dialg box
     def colourlabel(self):
         """Dialog box for queries"""
         self.value = None # Reset to allow new queries
         self.open_custom_dialog()
     
-    # Method to deal with range queries
-    def evaluateRange(self, NameValue, condition):
-        """function to evaluate node names meeting range condition"""
-        ACCEPTED_LESS = ("L", "LESS", "LESS THAN", "LT", "LOWER", "BELOW", "LESSTHAN", "UNDER")
-        ACCEPTED_MORE = ("G", "GREATER", "GREATER THAN", "GT", "HIGHER", "MORE", "ABOVE", "GREATERTHAN")
-        if isinstance(condition, str):
-            testcondition = condition.split("_")[-1].replace("(","").replace(")","").split(",") # Pull entered values for testing and split to obtain needed value
-        else:
-            testcondition = condition[-1].replace("(","").replace(")","").split(",")
-        if len(testcondition) != 2: # Skip entries that are not valid conditions
-            pass
-        else:
-            try:
-                float(NameValue[1])
-                float(testcondition[1]) # test that value in question is testable to avoid errors  
-                if testcondition[0].upper() in ACCEPTED_LESS: # if request is to search values less than that specified
-                    if float(NameValue[1]) < float(testcondition[1]):
-                        return True
-                    return False
-                elif testcondition[0].upper() in ACCEPTED_MORE: # if request is to search values greater than that specified
-                    if float(NameValue[1]) >= float(testcondition[1]):
-                        return True
-                    return False       
-                elif float(NameValue[1]) >= float(testcondition[0]) and float(NameValue[1]) <= float(testcondition[1]): # select a range of values
-                        return True
-                else:
-                    return False # catch other cases
-            except (ValueError, TypeError, IndexError):
-                print("Data type Error!")      
-
-    # Methods passed here to conduct actual leaf colouring
-    def colorLeaves(self, node, value):
-    # Define the condition to determine leaf colors
-        colourvals = ("COLOUR", "COLOR", "COL")
-        if not any("(" in i for i in value[0:len(value)-1]): # this block runs if no complex queries are written. This limits possibility of errors.
-            if all(i.upper() in node.name.upper() for i in value[0:len(value)-1]):
-                if any(i for i in colourvals if i in value[-1].upper()):
-                    temp = value[-1].split("_")[1]
-                    node.img_style["bgcolor"] = temp
-                else:
-                    node.img_style["bgcolor"] = value[-1]
-            else:
-                node.img_style["bgcolor"] = "white"
-        #Add logic to deal with ranges 
-        else:
-            valuetest = [i.split("_") for i in value[0:len(value)-1]]
-            nodetest = [x.split("_") for x in node.name.upper().split(" // ")[1:]] # create list of lists dividing each label with its corresponding value
-            valid = [False for i in range(0, len(value)-1)] #need to validate all search criteria in order to colour branch
-            for i, item in enumerate(valuetest):
-                for j in nodetest:
-                    if item[0].upper() == j[0].upper() and "(" not in item[1]: # Evaluate non-complex values as direct comparisons
-                        if item[1].upper() == j[1].upper():
-                            valid[i] = True
-                    elif item[0].upper() == j[0].upper() and "(" in item[1]: # Evaluate complex expressions with range function
-                        if self.evaluateRange(j, item):
-                            valid[i] = True
-            if all(valid): #Colour only if all requested conditions are met
-                if any(i for i in colourvals if i in value[-1].upper()):
-                    temp = value[-1].split("_")[1]
-                    node.img_style["bgcolor"] = temp
-                else:
-                    node.img_style["bgcolor"] = value[-1]
-            else:
-                node.img_style["bgcolor"] = "white"
-
     # Remove all colour formatting
     def clearColor(self):
         """Remove colour labels from tree"""
         self.colourstrainStatus, self.colourStatus = False, False
         self.value = None
-        for i in self.LTree.get_leaves():
-            i.img_style['bgcolor'] = "#FFFFFF"
+        if self.treeViews:
+            for tree, state in self.treeViews.views():
+                tree.bgcolor[:] = BACKGROUND
         text_box.insert(tk.END, "\nColour labelling has been cleared!.")
 
     # Use dictionary to reference original names and change tree acordingly
@@ -1039,50 +1246,30 @@ class Application(tk.Frame, tk.Text):
     def collapseTree(self):
         """Collapse nodes not selected in sublist"""
         if not self.pruneStatus:
-            for item in self.strainList:
-                self.collapseList.append(self.reference[item])
+            self.collapseList.extend(self.tree_names(self.strainList))
             self.collapseStatus = True
             return self.collapseList
         else:
             text_box.insert(tk.END, 'Pruning options have already been applied. Please reset options to collapse.')
 
-    # Collapse branches containing selected strains
-    def collapseBranches(self, node, depth):
-        if depth == 0:
-            for leaf in node.get_leaves():
-                if leaf.name in self.collapseList:
-                    node.img_style["draw_descendants"] = False
-                    return
-        elif not node.is_leaf():
-            for child in node.children:
-                self.collapseBranches(child, depth - 1) #Change depth to modify collapse extent
-
     # Method 1 to colour strains in subset list
     def colourStrainActive(self):
         self.colourstrainStatus = True
     
     # Method 2 to colour strains in subset list
-    def colourStrain(self, node):
-        for i in self.strainList:
-            if i in node.name:
-                node.img_style["bgcolor"] = "#FEE715"
+    def colourStrain(self):
+        found = colour_strains(self.LTree, self.strainList, self.reference)
+        if found < len(self.strainList):
+            text_box.insert(tk.END, f"\n\n{len(self.strainList) - found} selected strains are not in the tree.")
+        return found
 
     # Export labelled information to external file
     def export_labelled(self):
         """Method allowing CSV export of tree names that have been color labelled"""
         try:
             if self.LTree:  # Check that tree exists
-                output_list = []
-                for node in self.LTree.iter_descendants():  # Traverse all nodes in tree
-                    if "bgcolor" in node.img_style and node.img_style["bgcolor"] != "#FFFFFF":
-                        if node.is_leaf():  # Only consider labeled leaves 
-                            output_list.append(node.name)
-                        else:
-                            # Traverse descendants to include labeled leaves in subtrees
-                            labeled_leaves = [leaf.name for leaf in node.iter_leaves() if
-                                            "bgcolor" in leaf.img_style and leaf.img_style["bgcolor"] != "#FFFFFF"]
-                            print(labeled_leaves)
-                            output_list.extend(labeled_leaves)
+                # Only consider labeled leaves (non-matching query leaves are set to the background colour)
+                output_list = [name for name, leaf in self.leafIndex.items() if self.LTree.bgcolor[leaf] != BACKGROUND]
                 if not output_list:
                     text_box.insert(tk.END, "\nNothing labeled to export!")
                 else:
@@ -1102,8 +1289,7 @@ class Application(tk.Frame, tk.Text):
     def export_treenames(self):
         """Extract tree names from newick"""
         if self.LTree:
-            leaf_names = self.LTree.get_leaf_names()
-            output = "\n".join([i for i in leaf_names])
+            output = "\n".join(self.leafIndex)
             with open("treenames.txt", "w") as f:
                 f.write(output)
             text_box.insert(tk.END, "\n\nTree file names have been exported to \"treenames.txt\"")
@@ -1120,6 +1306,10 @@ class Application(tk.Frame, tk.Text):
         elif self.toggle == 2:
             self.render_options["equalize_branch"] = not self.render_options["equalize_branch"]
             text_box.insert(tk.END, "\n\nTree will be written to file with equalized branch lengths")
+        elif self.toggle == 3:
+            self.render_options["tiles"] = True
+            self.render_options["equalize_branch"] = False
+            text_box.insert(tk.END, '\n\nTree will be written as zoomable tiles to "tree_tiles" (open tree_tiles/index.html)')
         else:
             for key in self.render_options.keys():
                 self.render_options[key] = False
@@ -1129,33 +1319,59 @@ class Application(tk.Frame, tk.Text):
     # Exchange tree names based on file upload
     def tree_exchange(self):
         """Exchange tree file names with import"""
+        if not self.idle():
+            return None
         filename = filedialog.askopenfilename()
         if filename:
             if "csv" or "xls" in filename:
                 text_box.insert(tk.END, '\n\nSelected: ' + str(filename))
-                #Data processing
-                if "csv" in filename:
-                    name_exchange_df = pd.read_csv(filename, encoding="ISO-8859-1", header=None)
-                else:
-                    name_exchange_df = pd.read_excel(filename, header=None)
+                #Data processing in the background
+                def job(report):
+                    return cached_table(filename, self.tableCache, "names", header=None)
+                self.run_job("Name exchange", job, on_done=self.exchange_names, on_error=lambda e: self.call_error(10))
         else:
             self.call_error(10) # file input error
-            
+
+    # Rename tree leaves once the exchange table has been read
+    def exchange_names(self, name_exchange_df):
+        """Swap old tree names for new ones in every view"""
         # old:new name dictionary
         name_exchange = dict(name_exchange_df.values)
 
-        # get leaves
-        leaf_nodes = self.LTree.get_leaves()
-        
-        # Perform exchange 
-        for leaf in leaf_nodes:
-            old_name = leaf.name
-            new_name = name_exchange.get(old_name)
-            if new_name:
-                leaf.name = new_name
-        
+        # Perform exchange on every view and keep leaf lookups in step
+        for tree, state in self.treeViews.views():
+            tree.rename_leaves(lambda name: str(name_exchange[name]) if name_exchange.get(name) else None)
+            state.clear() # name faces are rebuilt with the new names
+        self.leafIndex = self.LTree.leaf_index
+
         text_box.insert(tk.END, '\n\nName exchange has been performed. Verify tree!')
 
+    # Change depth at which branches are collapsed
+    def collapse_depth(self):
+        """Ask for the node depth used by collapse"""
+        depth = simpledialog.askinteger("Collapse Depth", "Collapse branches at node depth (1 = root children): ",
+                                        initialvalue=self.collapseDepth, minvalue=1)
+        if depth:
+            self.collapseDepth = depth
+            text_box.insert(tk.END, f"\n\nBranches will be collapsed at node depth {depth}")
+
+    # Cycle the format of rendered tree files
+    def image_format(self):
+        """Toggle between PNG, SVG and PDF tree files"""
+        formats = ["png", "svg", "pdf"]
+        self.imageFormat = formats[(formats.index(self.imageFormat) + 1) % len(formats)]
+        text_box.insert(tk.END, f'\n\nRendered trees will be written to "tree_out.{self.imageFormat}"')
+
+    # Change the level of detail for large trees
+    def level_of_detail(self):
+        """Ask for the smallest height in pixels a clade is drawn with before it is summarised"""
+        pixels = simpledialog.askinteger("Level of Detail", "Summarise clades drawn smaller than this many pixels "
+                                         "(0 draws every leaf): ", initialvalue=self.detailPixels, minvalue=0)
+        if pixels is not None:
+            self.detailPixels = pixels # drawn nodes are rebuilt at the new level of detail when next shown
+            text_box.insert(tk.END, f"\n\nClades smaller than {pixels} pixels will be summarised in rendered images" if pixels
+                            else "\n\nEvery leaf will be drawn")
+
     # Change tree topology settings
     def tree_topology(self):
         # Pass to tree style
@@ -1174,31 +1390,18 @@ class Application(tk.Frame, tk.Text):
             filename = simpledialog.askstring("Output Filename", "Enter output tree file name: ")
             if ".nw" not in filename:
                 filename = f"{filename}.nw"
-            self.LTree.write(format=1, outfile=filename)
+            with open(filename, "w") as f:
+                f.write(self.LTree.newick())
             text_box.insert(tk.END, "\nExport successful!")
         else:
             self.call_error(6)
 
     # Generate colours for heatmap
-    def generate_color(self, value, code):
-        if code == 1:
-            # Convert values between 0 and 1 to 255 scale
-            gray_value = int((1 - value) * 255)
-            # Derive hex code for grayscale from this value
-            hex_code = "#{:02X}{:02X}{:02X}".format(gray_value, gray_value, gray_value)
-        elif code == 2:
-            # Calculate the green component based on the value
-            red = int((value) * 255)
-            blue = int((1-value) * 255) 
-            # Generate the hex code for the color (white to green gradient)
-            hex_code = "#{:02X}{:02X}{:02X}".format(red, 0, blue)
-        else:
-            # Calculate the green component based on the value
-            green = int((1 - value) * 255)
-            # Generate the hex code for the color (white to green gradient)
-            hex_code = "#{:02X}{:02X}{:02X}".format(255, green, 0)
-
-        return hex_code
+    def heatmap_colours(self, code):
+        """Colour matrix for the processed heatmap, computed once per colour scheme"""
+        if code not in self.hmcolours:
+            self.hmcolours[code] = generate_colors(self.new_hm, code)
+        return self.hmcolours[code]
 
     # Add heatmap with selected formatting to tree
     def ApplyHeatmap(self):
@@ -1217,105 +1420,87 @@ class Application(tk.Frame, tk.Text):
     # Apply tree settings and show
     def ShowTree(self):
         # Style the tree with basic features
-        ts = TreeStyle()
-        ts.mode = self.tree_topology_output 
-        ts.show_leaf_name = False
-        ts.branch_vertical_margin = 50
-        ts.scale = 150
+        ts = tree_style(self.tree_topology_output)
         # Apply styles and Show Tree
+        if not self.idle(): # the tree may still be loading or rendering
+            return None
         if self.LTree:
-            for node in self.LTree.traverse():
-                # disable default node shapes
-                node.img_style["size"] = 0
-                node.img_style["shape"] = "sphere"
-                node.img_style["fgcolor"] = "black"
-                # Add tip names in a custom position
-                if node.is_leaf() and self.nodefaces == 0:
-                    nameF = TextFace(node.name, fsize=30, fgcolor="slateGrey")
-                    node.add_face(nameF, column=1, position="branch-right")
-
-            self.nodefaces += 1 #Stops duplication of names 
-            # Pruning if requested
-            if self.pruneStatus:
-                self.LTree.prune(self.pruneList)
+            # Pruning if requested, using a cached copy so the whole tree is kept
+            self.select_view()
             
             # Collapse nodes not containing selected strains
             if self.collapseStatus:
-                self.collapseBranches(self.LTree, 2) 
+                collapse_branches(self.LTree, self.collapseDepth, self.collapseList)
 
             # Colour tree leaves if requested
 
             if self.colourStatus:
-                for leaf in self.LTree.iter_leaves():
-                    self.colorLeaves(leaf, self.value)
+                matched = colour_query(self.LTree, self.reference, self.df, self.value, self.genomap_rows())
+                text_box.insert(tk.END, f"\n\n{matched} leaves match the label search.")
             
             # Apply strain colouring if selected
 
             if self.colourstrainStatus:
-                for leaf in self.LTree.iter_leaves():
-                    self.colourStrain(leaf)
+                self.colourStrain()
 
             # Building the heatmap
-            if self.heatmapStatus and self.heatmapfaces == 0:
-                # Create rectangular faces in order to build heatmap
-
-                num_columns = len(self.new_hm[0]["values"]) # Get the number of columns
-                for column in range(num_columns):
-                    for data in self.new_hm:
-                        leaf_name = data["name"]
-                        values = data["values"]
-                        value = values[column]
-                        leaf_node = self.LTree & leaf_name # Get the node corresponding to the leaf name
-                        if self.heatmapGray:
-                            color = self.generate_color(value, 1) # Customize colors based on presence/absence
-                        elif self.heatmapBlue:
-                            color = self.generate_color(value, 2) # Customize colors based on presence/absence
-                        else:
-                            color = self.generate_color(value, 3) # Customize colors based on presence/absence
-
-                        if self.heatmap_valuestatus:
-                            value_face = TextFace(text=f'{value:.2f}_', fsize=5, fgcolor=color, bold=True) # limit values to 2 SF otherwise display is crowded
-                            leaf_node.add_face(value_face, column=column, position="aligned")
-                        else:
-                            rect_face = RectFace(width=30, height=30, fgcolor="black", bgcolor=color, label="X")
-                            leaf_node.add_face(rect_face, column=column, position="aligned")
-                        
-                        self.heatmapfaces += 1 # stop duplicate heatmaps when reimaging tree
-                    
+            heatmap, header = None, []
+            if self.heatmapStatus:
+                if "heatmap" not in self.viewState:
+                    # Create rectangular faces in order to build heatmap
+                    if self.heatmapGray:
+                        colours = self.heatmap_colours(PALETTES["Grayscale"]) # Customize colors based on presence/absence
+                    elif self.heatmapBlue:
+                        colours = self.heatmap_colours(PALETTES["Blue-Red"])
+                    else:
+                        colours = self.heatmap_colours(PALETTES["Red-Orange-Yellow"])
+                    pairs, missing = heatmap_leaves(self.leafIndex, self.reference, self.hmrows)
+                    self.viewState["heatmap"] = (pairs, self.new_hm, colours, self.heatmap_valuestatus) # kept with the view
+                    if missing:
+                        text_box.insert(tk.END, f"\n\n{missing} heatmap rows do not match a tree leaf and were skipped.")
+                heatmap = self.viewState["heatmap"]
+
                 # Add label for each column as a header if desired (this is the default)
-                    if self.labelstatus:
-                        column_label = TextFace(f"{self.hmcolumns[column]}", fsize=10) # Retrieve col name by index
-                        column_label.rotation = 90 # Rotate the label by 90 degrees
-                        ts.aligned_header.add_face(column_label, column=column)      
+                if self.labelstatus:
+                    header = self.hmcolumns
+                    add_heatmap_header(ts, header)
 
             # Show the tree
-            self.master.attributes("-disabled", True) # Freeze the main window when tree is displayed
             if not self.render_options["render"]: 
-                self.LTree.show(tree_style=ts)
+                # Colours and collapsed branches are kept on the compact tree, only nodes changed since the last view
+                # are restyled. Every leaf is drawn so any clade can be expanded and zoomed into
+                nodes = self.display_nodes(heatmap)
+                apply_styles(nodes, self.LTree, (), self.viewState["applied"])
+                self.master.attributes("-disabled", True) # Freeze the main window when tree is displayed
+                nodes[0].show(tree_style=ts)
+                self.master.attributes("-disabled", False) # Unfreeze the main window when tree is displayed
+                self.master.deiconify() # Keep tkinter window in front
+            elif self.render_options["tiles"]:
+                # tiles are rendered by a pool of worker processes started from a background thread
+                drawing = TreeDrawing(self.LTree, self.render_summaries(), heatmap, self.tree_topology_output, header)
+                self.run_job("Tree tiles", lambda report: render_tiles(drawing, "tree_tiles", os.cpu_count() or 1,
+                                                                       progress=report),
+                             on_done=lambda levels: text_box.insert(tk.END, f'\n\nTree tiles with {levels + 1} zoom levels '
+                                                                           'output to "tree_tiles/index.html"'))
             else:
-                if self.render_options["equalize_branch"]:
-                    for node in self.LTree.traverse():
-                        node.dist = 1.0
-                self.LTree.render("tree_out.png", w=1200, h=800, units="px", tree_style=ts) # write tree to file
-                text_box.insert(tk.END, '\n\nTree file output to "tree_out.png"')
-            self.master.attributes("-disabled", False) # Unfreeze the main window when tree is displayed
-            self.master.deiconify() # Keep tkinter window in front
+                # write tree to file in a separate process so the window stays usable, sending the compact tree
+                # as ete3 nodes cannot be pickled for deep trees
+                filename = f"tree_out.{self.imageFormat}"
+                drawing = TreeDrawing(self.LTree, self.render_summaries(), heatmap, self.tree_topology_output, header)
+                self.run_job("Tree rendering", render_drawing, drawing, filename, 1200, 800, self.render_options["equalize_branch"],
+                             on_done=lambda result: text_box.insert(tk.END, f'\n\nTree file output to "{filename}" '
+                                                                           f'({result[0] / 1e6:.2f} MB in {result[1]:.1f} s)'),
+                             process=True)
         else:
             text_box.insert(tk.END, '\n\nNo valid tree can be created. Have you uploaded all files?')
   
     # Clears all inputs for new analysis
     def Reset(self):
         """Function to Wipe all Settings"""
-        self.subList, self.pruneList, self.strainList, self.collapseList = [],[],[],[]
-        self.reference = {} #Dictionary allowing modified newick filename retrieval from original strain name (GenomeID)
-        val = [False] * 7
-        self.pruneStatus, self.collapseStatus, self.colourStatus, self.colourstrainStatus, self.heatmap_valuestatus, self.heatmapStatus, self.heatmapGray = val
-        self.labelstatus = True
-        self.nodefaces, self.heatmapfaces = 0, 0 #Counter to limit duplicate branch names when tree reloaded
-        self.df, self.newdf, self.LTree = "", "", None
-        self.options_1, self.options_2 = ["NONE"],["NONE"]
-        self.new_hm, self.hm = "", ""
-        self.create_widgets() # Recreate menu buttons
+        self.jobs.cancel() # results of running uploads belong to the old analysis
+        self.init_session() # tables, tree and their caches are dropped, the widgets are kept
+        self.clear_menus()
+        gc.collect() # ete3 trees hold reference cycles, free them now rather than at some later upload
         text_box.delete(1.0,tk.END)
         text_box.insert(tk.END, 'Console Reset. Please upload new files.')
 
@@ -1336,7 +1521,9 @@ class Application(tk.Frame, tk.Text):
             8:"File not valid. Please upload file in Excel or csv format. If problems persist get in touch.",
             9:"Not possible to extract names due to absence of tree file. Please verify upload.",
             10:"Problem with file upload. Verify that you have simply two columns: old names and new names.",
-            11:"Issue with GenomeID Extraction. Ensure that IDs matching tree branch names are in the first column of the table. You can extract these from your tree using the other tools section"
+            11:"Issue with GenomeID Extraction. Ensure that IDs matching tree branch names are in the first column of the table. You can extract these from your tree using the other tools section",
+            12:"Query could not be processed. Please check that labels match the genomap column names.",
+            13:"Strain list could not be read. Please upload a text file with one ID per line or a csv/Excel file with IDs in the first column."
         }
         text_box.insert(tk.END, f'\n\n{reference[code]}')
 
@@ -1350,7 +1537,64 @@ class Application(tk.Frame, tk.Text):
 
 # Main Portion of Program
 
-def main():
+# Slowest acceptable start in a fresh interpreter, from import until the window is drawn, in seconds
+STARTUP_SECONDS = 0.5
+
+# Run by startup_benchmark: times the import, then building and drawing the window as main does
+STARTUP_SCRIPT = """
+import time, tkinter
+start = time.perf_counter()
+import TreeExplorer
+imported = time.perf_counter()
+try:
+    window = TreeExplorer.build_window()
+    window.update()
+    print(imported - start, time.perf_counter() - imported)
+    window.destroy()
+except tkinter.TclError: # no display to open the window on
+    print(imported - start)
+"""
+
+# Startup benchmark
+def startup_benchmark(limit=STARTUP_SECONDS, shown=10):
+    """Time importing the GUI and opening its window in a fresh interpreter with -X importtime, print the slowest
+    imports and return 1 if start-up took longer than limit seconds"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT], cwd=here,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        return 1
+    times = {} # cumulative microseconds by module, as reported by -X importtime
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    for name, micro in sorted(times.items(), key=lambda item: -item[1])[:shown]:
+        print(f"{micro / 1e3:9.1f} ms  {name}")
+    seconds = [float(value) for value in result.stdout.split()] # import, then window when there is a display
+    total = sum(seconds)
+    print(f"Tree Explorer imports in {seconds[0]:.3f} s")
+    if len(seconds) > 1:
+        print(f"Window with widgets and logo drawn in {seconds[1]:.3f} s")
+    else:
+        print("No display, the window was not timed")
+    print(f"Start-up took {total:.3f} s (limit {limit:.3f} s)")
+    return 0 if total <= limit else 1
+
+# Command line options
+def build_parser():
+    """Argument parser for the GUI entry point"""
+    parser = argparse.ArgumentParser(prog="trex", description="Tree Explorer: label and explore phylogenetic trees.")
+    parser.add_argument("--startup-benchmark", nargs="?", type=float, const=STARTUP_SECONDS, metavar="SECONDS",
+                        help="time the import of the GUI and opening its window, then close it and fail if "
+                             "this is slower than SECONDS "
+                             f"(default: {STARTUP_SECONDS})")
+    return parser
+
+# Main window as shown at start-up
+def build_window():
+    """Create the root window with the application widgets and console, ready for mainloop"""
     # Main Functions
     def scroll_text(*args):
         text_box.yview(*args)
@@ -1360,6 +1604,7 @@ def main():
 
     # Set DPI awareness level
     try:
+        import ctypes # Needed for dpi reset
         ctypes.windll.shcore.SetProcessDpiAwareness(1)  # PROCESS_SYSTEM_DPI_AWARE
     except AttributeError:
         pass 
@@ -1386,7 +1631,13 @@ def main():
     text_box.configure(font=("Helvetica", 16, "italic"), highlightthickness=1, highlightbackground="black", relief="solid", background="#F0F0F0")
     scrollbar.grid(row=0, column=10, sticky='ns')
     text_box.insert(tk.END, "Welcome to Tree Explorer.\n\nPlease upload genogroup and tree files to get started. \n\nClick 'About' for more information.")
-    root.mainloop()
+    return root
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    if options.startup_benchmark is not None:
+        sys.exit(startup_benchmark(options.startup_benchmark))
+    build_window().mainloop()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -4,15 +4,21 @@ setup(
     name="TreeExplorer-Python",
     version="1.2",
     packages=find_packages(),
+    py_modules=["TreeExplorer", "TreeCore", "TreeBatch"],
     install_requires=[
         "ete3",
-        "pandas",
+        "pandas>=1.2",
+        "numpy",
         "openpyxl",
         "Pillow"
     ],
+    extras_require={
+        "zst": ["zstandard"], # reading .csv.zst genomaps
+    },
     entry_points={
         'console_scripts': [
             'trex=TreeExplorer:main',
+            'trex-batch=TreeBatch:main',
         ],
     },
     author="Damian Magill",
@@ -26,5 +32,5 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.9',
 )
@@ -0,0 +1,65 @@
+import os
+import random
+import sys
+
+import ete3
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TreeCore import CompactTree, TableCache, load_newick
+
+# Random tree with named internal nodes, some with more than two children
+def random_tree(seed, leaves=60):
+    random.seed(seed)
+    tree = ete3.Tree()
+    tree.populate(leaves, random_branches=True)
+    for i, node in enumerate(tree.traverse("preorder")):
+        if not node.is_leaf():
+            node.name = f"N{i}"
+        if not node.is_leaf() and not node.is_root() and random.random() < 0.2:
+            node.delete() # joins its children to its parent
+    return tree
+
+@pytest.mark.parametrize("seed", range(10))
+def test_newick_matches_ete3(seed):
+    tree = random_tree(seed)
+    assert CompactTree.from_tree(tree).newick() == tree.write(format=1)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_prune_matches_ete3(seed):
+    tree = random_tree(seed)
+    compact = CompactTree.from_tree(tree)
+    names = [node.name for node in tree.traverse() if not node.is_root()]
+    keep = random.sample(names, random.randint(1, 15))
+    pruned = compact.prune(keep)
+    tree.prune(keep)
+    expected = tree.write(format=1)
+    assert pruned.to_nodes()[0].write(format=1) == expected
+    assert pruned.newick() == expected
+
+def test_prune_unknown_name():
+    with pytest.raises(ValueError):
+        CompactTree.from_tree(random_tree(0)).prune(["missing"])
+
+def test_long_name_does_not_widen_names(tmp_path):
+    tree = random_tree(0, leaves=200)
+    compact = CompactTree.from_tree(tree)
+    size = compact.names.nbytes
+    leaf = compact.leaf_names()[0]
+    compact.rename_leaves(lambda name: "x" * 2000 if name == leaf else None)
+    assert compact.names.nbytes <= size + 8
+    assert len(compact.find(["x" * 2000])) == 1
+
+def test_tree_cache_round_trip(tmp_path):
+    tree = random_tree(1)
+    for node in tree.traverse():
+        if not node.is_leaf():
+            node.name = "" # newick files are read in ete3's default format, which has no internal names
+    tree.get_leaves()[0].name = "é" + "x" * 2000
+    path = tmp_path / "tree.nwk"
+    path.write_text(tree.write(format=1))
+    cache = TableCache(str(tmp_path / "cache"))
+    first = load_newick(str(path), cache)
+    second = load_newick(str(path), cache) # read from tree.nwk.trex.npz
+    assert (tmp_path / "tree.nwk.trex.npz").exists()
+    assert second.newick() == first.newick() == tree.write(format=1)
@@ -0,0 +1,88 @@
+import os
+import sys
+
+import ete3
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from TreeCore import BACKGROUND, HIGHLIGHT, CompactTree, colour_query, compile_query, query_columns, query_mask
+
+# Genomap with typed numbers, text and missing values
+@pytest.fixture
+def df():
+    return pd.DataFrame({"GenomeID": ["ST1", "ST2", "ST3", "ST4", "ST5", "ST6"],
+                         "prtS": [1, 0, 1, 0, 1, 0],
+                         "pH": [4.5, 6.0, 3.0, 5.0, np.nan, 4.9],
+                         "Lysotype": ["A", "B", "A", "C", "B", None]})
+
+def matches(df, query):
+    """Genome IDs matched by each rule of the query and the rule colours"""
+    rules = compile_query(query, df.columns[1:])
+    return [(df["GenomeID"][query_mask(df, expr)].tolist(), colour) for expr, colour in rules]
+
+# Searches written before OR, NOT, -> and ; were added must keep their meaning
+@pytest.mark.parametrize("query, ids, colour", [
+    ("prtS_1 AND yellow", ["ST1", "ST3", "ST5"], "yellow"),
+    ("prts_1 AND yellow", ["ST1", "ST3", "ST5"], "yellow"),
+    ("prtS_0 AND colour_blue", ["ST2", "ST4", "ST6"], "blue"),
+    ("pH=(L,5) AND colour=red", ["ST1", "ST3", "ST6"], "red"),
+    ("pH=(less,5) AND colour=red", ["ST1", "ST3", "ST6"], "red"),
+    ("pH=(G,5) AND colour=red", ["ST2", "ST4"], "red"),
+    ("pH=(4,5) AND COLOUR=green", ["ST1", "ST4", "ST6"], "green"),
+    ("prtS=1 AND pH=(L,5) AND colour=red", ["ST1", "ST3"], "red"),
+    ("Lysotype=A AND color=red", ["ST1", "ST3"], "red"),
+    ("lysotype=a AND red", ["ST1", "ST3"], "red"),
+    ("prtS=1", ["ST1", "ST3", "ST5"], HIGHLIGHT),
+])
+def test_legacy_queries(df, query, ids, colour):
+    assert matches(df, query) == [(ids, colour)]
+
+@pytest.mark.parametrize("query, ids, colour", [
+    ("prtS=1 -> red", ["ST1", "ST3", "ST5"], "red"),
+    ("prtS=1 OR Lysotype=C -> red", ["ST1", "ST3", "ST4", "ST5"], "red"),
+    ("NOT prtS=1 -> blue", ["ST2", "ST4", "ST6"], "blue"),
+    ("prtS=1 AND (pH<5 OR NOT Lysotype=A) -> red", ["ST1", "ST3", "ST5"], "red"),
+    ("prtS=1 and pH<5 -> red", ["ST1", "ST3"], "red"),
+    ("pH>=5 -> #00FF00", ["ST2", "ST4"], "#00FF00"),
+    ("pH<=4.9 -> red", ["ST1", "ST3", "ST6"], "red"),
+    ("pH>5 -> red", ["ST2"], "red"),
+    ("Lysotype!=A -> red", ["ST2", "ST4", "ST5", "ST6"], "red"),
+    ('"Lysotype"=="B" -> red', ["ST2", "ST5"], "red"),
+])
+def test_new_queries(df, query, ids, colour):
+    assert matches(df, query) == [(ids, colour)]
+
+def test_rules_are_split_on_semicolons(df):
+    assert matches(df, "prtS=1 -> red; pH<5 -> blue\nLysotype_C AND green") == [
+        (["ST1", "ST3", "ST5"], "red"), (["ST1", "ST3", "ST6"], "blue"), (["ST4"], "green")]
+
+def test_first_matching_rule_colours_a_leaf(df):
+    tree = CompactTree.from_tree(ete3.Tree("((ST1,ST2),(ST3,(ST4,(ST5,ST6))));"))
+    rules = compile_query("prtS=1 -> red; pH<5 -> blue", df.columns[1:])
+    assert colour_query(tree, {}, df, rules) == 4
+    colours = {name: tree.bgcolor[node] for name, node in tree.leaf_index.items()}
+    assert colours == {"ST1": "red", "ST2": BACKGROUND, "ST3": "red", "ST4": BACKGROUND, "ST5": "red", "ST6": "blue"}
+
+def test_query_columns_in_order_of_use(df):
+    rules = compile_query("pH<5 AND Lysotype=A -> red; prtS=1 OR pH>6 -> blue", df.columns[1:])
+    assert query_columns(rules) == ["pH", "Lysotype", "prtS"]
+
+@pytest.mark.parametrize("query", [
+    "",
+    "unknown=1 -> red",
+    "unknown_1 AND red",
+    "pH<abc -> red",
+    "prtS=1 ->",
+    "(prtS=1 -> red",
+    "prtS=1) -> red",
+    "pH=(X,5) AND red",
+    "pH<(4,5) -> red",
+    "prtS= -> red",
+    "prtS=1 AND -> red",
+    "prtS=1 AND colour=red -> blue", # with an arrow the colour term is read as a column
+])
+def test_invalid_queries(df, query):
+    with pytest.raises(ValueError):
+        compile_query(query, df.columns[1:])